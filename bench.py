@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import json
+import sqlite3
+import sys
+import time
+from collections import Counter
+from web3 import Web3
+from setup import BONDING_MANAGER_PROXY, BONDING_MANAGER_ABI, ROUND_MANAGER_PROXY, ROUND_MANAGER_ABI, TICKET_BROKER_PROXY
+from multicall import get_multicall
+from replay import CountingProvider, ReplayProvider, load_watcher
+from store import Store
+
+NEW_ROUND_TOPIC = "0x22f2fc17c5daf07db2379b3a03a8ef20a183f761097a58fce219c8a14619e786"
+TRANSCODER_UPDATE_TOPIC = "0x7346854431dbb3eb8e373c604abf89e90f4865b8447e1e2834d7b3e4677bf544"
+REWARD_TOPIC = "0x619caafabdd75649b302ba8419e48cccf64f37f1983ac4727cfb38b57703ffc9"
+TICKET_TOPIC = "0x8b87351a208c06e3ceee59d80725fd77a23b4129e1b51ca231fc89b40712649c"
+
+# Active set size of the Livepeer protocol
+POOL_SIZE = 100
+ROUND = 3000
+ROUND_LENGTH = 5760
+TICKETS_PER_ORCHESTRATOR = 3
+
+def topic(value):
+    return "0x" + hex(value)[2:].rjust(64, "0")
+
+def address_topic(address):
+    return "0x" + address[2:].lower().rjust(64, "0")
+
+def word(value):
+    return hex(value)[2:].rjust(64, "0")
+
+class SyntheticChain(CountingProvider):
+    """Simulates the Livepeer contracts for a round with the given number of orchestrators.
+
+    The first POOL_SIZE orchestrators are active, 90% of them call reward, every orchestrator redeems
+    TICKETS_PER_ORCHESTRATOR winning tickets and 1% change their reward/fee cut. The round starts at block 1.
+    Like ReplayProvider it counts the JSON-RPC requests per method, the contract functions called (also within
+    a Multicall3 aggregate3) are counted in functionCalls.
+    """
+
+    def __init__(self, size, blocks=ROUND_LENGTH):
+        super().__init__()
+        self.functionCalls = Counter()
+        self.w3 = Web3()
+        self.orchestrators = [Web3.toChecksumAddress("0x" + hex(0x1000 + i)[2:].rjust(40, "0")) for i in range(size)]
+        self.pool = self.orchestrators[:POOL_SIZE]
+        self.nextInPool = dict(zip(self.pool, self.pool[1:]))
+        self.blocks = blocks
+        self.contracts = {
+            BONDING_MANAGER_PROXY: self.w3.eth.contract(address=BONDING_MANAGER_PROXY, abi=json.loads(BONDING_MANAGER_ABI)),
+            ROUND_MANAGER_PROXY: self.w3.eth.contract(address=ROUND_MANAGER_PROXY, abi=json.loads(ROUND_MANAGER_ABI)),
+        }
+        multicall = get_multicall(self.w3)
+        self.contracts[multicall.address] = multicall
+        self.logs = self._make_logs()
+
+    def _make_logs(self):
+        logs = [(1, ROUND_MANAGER_PROXY, [NEW_ROUND_TOPIC, topic(ROUND)], "0x" + word(0))]
+        for i, address in enumerate(self.orchestrators):
+            block = 2 + i * (self.blocks - 2) // len(self.orchestrators)
+            if address in self.nextInPool or address == self.pool[-1]:
+                if i % 10:
+                    logs.append((block, BONDING_MANAGER_PROXY, [REWARD_TOPIC, address_topic(address)], "0x" + word(10**20)))
+            if i % 100 == 0:
+                logs.append((block, BONDING_MANAGER_PROXY, [TRANSCODER_UPDATE_TOPIC, address_topic(address)], "0x" + word(50000) + word(900000)))
+            for t in range(TICKETS_PER_ORCHESTRATOR):
+                logs.append((block + t, TICKET_BROKER_PROXY, [TICKET_TOPIC, address_topic(address), address_topic(address)], "0x" + word(2 * 10**16)))
+        formatted = []
+        for logIndex, (block, address, topics, data) in enumerate(sorted(logs, key=lambda l: l[0])):
+            formatted.append({"address": address.lower(), "topics": topics, "data": data, "blockNumber": hex(block),
+                "blockHash": topic(block), "transactionHash": topic(logIndex), "transactionIndex": "0x0", "logIndex": hex(logIndex), "removed": False})
+        return formatted
+
+    def call(self, to, data):
+        contract = self.contracts[Web3.toChecksumAddress(to)]
+        fn, args = contract.decode_function_input(data)
+        name = fn.fn_name
+        with self.lock:
+            self.functionCalls[name] += 1
+        args = list(args.values())
+        stake = 10**24
+        if name == "aggregate3":
+            results = [(True, self.call(target, callData)) for target, allowFailure, callData in args[0]]
+            return self.w3.codec.encode_abi(["(bool,bytes)[]"], [results])
+        values = {
+            "currentRound": lambda: [ROUND],
+            "currentRoundStartBlock": lambda: [ROUND * ROUND_LENGTH],
+            "roundLength": lambda: [ROUND_LENGTH],
+            "getTranscoderEarningsPoolForRound": lambda: [stake, 100000, 500000, 0, 0],
+            "getTranscoder": lambda: [ROUND, 100000, 500000, 0, 0, 0, 0, 0, 0, 0],
+            "transcoderTotalStake": lambda: [stake],
+            "getFirstTranscoderInPool": lambda: [self.pool[0]],
+            "getTranscoderPoolSize": lambda: [len(self.pool)],
+            "getNextTranscoderInPool": lambda: [self.nextInPool.get(args[0], "0x" + "0" * 40)],
+            "isRegisteredTranscoder": lambda: [True],
+        }[name]()
+        return self.w3.codec.encode_abi([o["type"] for o in fn.abi["outputs"]], values)
+
+    def make_request(self, method, params):
+        self.count(method)
+        if method == "eth_call":
+            result = "0x" + self.call(params[0]["to"], params[0]["data"]).hex()
+        elif method == "eth_getLogs":
+            fromBlock, toBlock = int(params[0]["fromBlock"], 16), int(params[0]["toBlock"], 16)
+            result = [l for l in self.logs if fromBlock <= int(l["blockNumber"], 16) <= toBlock]
+        elif method == "eth_blockNumber":
+            result = hex(self.blocks)
+        elif method == "eth_chainId":
+            # Requested by the web3 validation middleware
+            result = hex(42161)
+        else:
+            return {"jsonrpc": "2.0", "id": 0, "error": {"code": -32601, "message": "not simulated: " + method}}
+        return {"jsonrpc": "2.0", "id": 0, "result": result}
+
+def report(name, provider, watcher, duration):
+    print("\n{}: {:.2f}s, {} RPC requests, {} notifications to {} chats, read cache hit rate {:.0%}".format(
+        name, duration, sum(provider.calls.values()), watcher.notifier.sent, len(watcher.notifier.chats), watcher.readCache.hit_rate()))
+    for method, count in provider.calls.most_common():
+        print("  {:>6}  {}".format(count, method))
+    if getattr(provider, "functionCalls", None):
+        print("  Contract functions called: " + ", ".join("{} {}".format(count, name) for name, count in provider.functionCalls.most_common()))
+
+def bench_synthetic(size):
+    chain = SyntheticChain(size)
+    store = Store(":memory:")
+    with store.transaction():
+        store.set_checkpoint("arbitrumBlock", 0)
+        store.set_checkpoint("mainnetBlock", 0)
+        store.set_checkpoint("roundNr", ROUND - 1)
+        for i, address in enumerate(chain.orchestrators):
+            # Two chats per orchestrator, half of the chats watch two orchestrators
+            store.add_subscription(address, i)
+            store.add_subscription(address, size + i // 2)
+    watcher = load_watcher(chain, store)
+    watcher.load_state()
+    watcher.update_transcoder_instances()
+    # The round before was fully rewarded
+    for t in watcher.transcoder.values():
+        t.rewardCalled = True
+    chain.calls.clear()
+    chain.functionCalls.clear()
+    start = time.time()
+    watcher.scan_range(1, chain.blocks)
+    report("{} orchestrators".format(size), chain, watcher, time.time() - start)
+
+def bench_replay(path, dbPath):
+    provider = ReplayProvider(path)
+    store = Store(":memory:")
+    source = sqlite3.connect(dbPath)
+    source.backup(store.conn)
+    watcher = load_watcher(provider, store)
+    watcher.load_state()
+    watcher.update_transcoder_instances()
+    ranges = []
+    for key in provider.responses:
+        method, params = json.loads(key)
+        if method == "eth_getLogs":
+            ranges.append((int(params[0]["fromBlock"], 16), int(params[0]["toBlock"], 16)))
+    start = time.time()
+    for fromBlock, toBlock in sorted(ranges):
+        watcher.commit_logs(watcher.get_logs(fromBlock, toBlock), toBlock)
+    report("Replay of {} ({} log ranges)".format(path, len(ranges)), provider, watcher, time.time() - start)
+
+if __name__ == '__main__':
+    if "--replay" in sys.argv:
+        i = sys.argv.index("--replay")
+        bench_replay(sys.argv[i + 1], sys.argv[i + 2])
+    else:
+        for size in [int(a) for a in sys.argv[1:]] or [100, 1000, 10000]:
+            bench_synthetic(size)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+from multicall import aggregate
+
+class ReadCache:
+    """Read-through cache for contract calls, keyed by (contract, function, args, block).
+
+    Meant to be filled once the logs of a processing window are known (so the reads already include
+    the changes of its events) and cleared after the window.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def call(self, fn, block="latest"):
+        """Returns fn.call(block_identifier=block), calling the contract only on a cache miss
+        """
+        key = (fn.address, fn.fn_name, tuple(fn.args), block)
+        if key in self.entries:
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        value = fn.call(block_identifier=block)
+        self.entries[key] = value
+        return value
+
+    def prefetch(self, multicall, fns, block="latest"):
+        """Reads all uncached calls with a single multicall, calls which reverted are left to call()
+        """
+        keys = {}
+        for fn in fns:
+            key = (fn.address, fn.fn_name, tuple(fn.args), block)
+            if key not in self.entries:
+                keys.setdefault(key, fn)
+        if not keys:
+            return
+        self.misses += len(keys)
+        for key, value in zip(keys, aggregate(multicall, list(keys.values()), block)):
+            if value is not None:
+                self.entries[key] = value
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Parts of the error messages providers return if the block range or the result of eth_getLogs is too large
+RANGE_ERRORS = ("more than", "too many", "block range", "range is too large", "response size", "limit exceeded", "timeout", "timed out")
+
+class ChunkSizer:
+    """Adapts the block range of a single eth_getLogs request.
+
+    Halves the range if the provider rejects it, grows it while requests are answered faster than targetTime
+    and shrinks it if they take longer.
+    """
+
+    def __init__(self, size=2000, minSize=1, maxSize=100000, targetTime=2.0):
+        self.size = size
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.targetTime = targetTime
+
+    def shrink(self):
+        self.size = max(self.minSize, self.size // 2)
+
+    def update(self, duration):
+        if duration < self.targetTime / 2:
+            self.size = min(self.maxSize, int(self.size * 1.5) + 1)
+        elif duration > self.targetTime:
+            self.size = max(self.minSize, int(self.size * 0.75))
+
+def is_range_error(ex):
+    """Checks if the exception is a provider complaining about the size of the log query
+    """
+    message = str(ex).lower()
+    return any(e in message for e in RANGE_ERRORS)
+
+def iter_chunks(get_logs, fromBlock, toBlock, sizer, prefetch=True):
+    """Yields (start, end, logs) for consecutive chunks covering fromBlock to toBlock (inclusive), in order.
+
+    get_logs(start, end) fetches the logs of one chunk. If a chunk is rejected as too large it is split.
+    With prefetch, the next chunk is fetched in a background thread while the caller handles the current one,
+    so get_logs has to use its own provider connection.
+    """
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    def fetch(start, end):
+        t = time.time()
+        logs = get_logs(start, end)
+        return logs, time.time() - t
+
+    pending = None
+    start = fromBlock
+    try:
+        while start <= toBlock:
+            if pending and pending[0] == start:
+                end, future = pending[1], pending[2]
+            else:
+                end, future = min(start + sizer.size - 1, toBlock), None
+            pending = None
+            try:
+                logs, duration = future.result() if future else fetch(start, end)
+            except Exception as ex:
+                if is_range_error(ex) and end > start:
+                    sizer.size = min(sizer.size, end - start + 1)
+                    sizer.shrink()
+                    continue
+                raise
+            sizer.update(duration)
+            nextStart = end + 1
+            if executor and nextStart <= toBlock:
+                nextEnd = min(nextStart + sizer.size - 1, toBlock)
+                pending = (nextStart, nextEnd, executor.submit(fetch, nextStart, nextEnd))
+            yield start, end, logs
+            start = nextStart
+    finally:
+        if executor:
+            executor.shutdown(wait=True)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# All metrics created in this process, in the Prometheus text format order
+registry = []
+
+# Default histogram buckets in seconds, from fast RPC calls to slow log scans
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        for name, labels, value in self.samples():
+            lines.append("{}{} {}".format(name, format_labels(labels), value))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """Gauge which is either set or, if a function is given, read from the function on every scrape
+    """
+    type = "gauge"
+
+    def __init__(self, name, help, function=None):
+        super().__init__(name, help)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def samples(self):
+        if self.function:
+            return [(self.name, (), self.function())]
+        return super().samples()
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total, n = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            counts = [c + 1 if value <= b else c for c, b in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, n + 1)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, (counts, total, n) in self.values.items():
+                for bucket, count in zip(self.buckets, counts):
+                    samples.append((self.name + "_bucket", labels + (("le", bucket),), count))
+                samples.append((self.name + "_bucket", labels + (("le", "+Inf"),), n))
+                samples.append((self.name + "_sum", labels, total))
+                samples.append((self.name + "_count", labels, n))
+        return samples
+
+def render():
+    return "\n".join(m.render() for m in registry) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(port, address="127.0.0.1"):
+    """Serves the metrics on http://address:port/metrics in a background thread
+    """
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+###
+# web3 middleware
+###
+
+RPC_LATENCY = Histogram("rpc_request_seconds", "Latency of the JSON-RPC requests per method, eth_call per contract function")
+RPC_ERRORS = Counter("rpc_errors_total", "Failed JSON-RPC requests per method, eth_call per contract function")
+
+def function_selectors(*contracts):
+    """Returns a dict 4 byte selector (hex) -> function name for the functions of the given contracts
+    """
+    from eth_utils import encode_hex, function_abi_to_4byte_selector
+    return {encode_hex(function_abi_to_4byte_selector(f)): f["name"] for c in contracts for f in c.abi if f["type"] == "function"}
+
+def rpc_metrics_middleware(selectors):
+    """web3 middleware recording the latency and errors of every request, eth_call is labeled with the called function
+    """
+    def middleware(make_request, w3):
+        def record(method, params):
+            name = method
+            if method == "eth_call":
+                data = params[0].get("data", "")
+                data = data if isinstance(data, str) else w3.toHex(data)
+                name = selectors.get(data[:10], method)
+            start = time.time()
+            try:
+                response = make_request(method, params)
+            except Exception:
+                RPC_ERRORS.inc(function=name)
+                raise
+            finally:
+                RPC_LATENCY.observe(time.time() - start, function=name)
+            if "error" in response:
+                RPC_ERRORS.inc(function=name)
+            return response
+        return record
+    return middleware
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import json
+import time
+from setup import MULTICALL3_ADDRESS, MULTICALL3_ABI
+from metrics import Counter, Histogram
+
+ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
+# Upper bound of sub-calls per aggregate3 request, keeps the eth_call below the provider gas/response limits
+BATCH_SIZE = 500
+
+# The eth_call of a batch is recorded as aggregate3 by the RPC middleware, these show what it contained
+MULTICALL_CALLS = Counter("rpc_multicall_calls_total", "Contract function calls batched into Multicall3 aggregate3 requests, per function")
+MULTICALL_LATENCY = Histogram("rpc_multicall_seconds", "Latency of the aggregate3 requests, labeled with the batched functions")
+
+def get_multicall(w3):
+    """Returns the Multicall3 contract for the given web3 instance
+    """
+    return w3.eth.contract(address=MULTICALL3_ADDRESS, abi=json.loads(MULTICALL3_ABI))
+
+def aggregate(multicall, calls, block="latest"):
+    """Executes the given contract function calls via Multicall3.aggregate3 at the pinned block.
+
+    calls is a list of bound contract functions, e.g. bonding_manager_proxy.functions.transcoderTotalStake(addr).
+    Returns the decoded results in the same order, None for sub-calls that reverted.
+    Single-value outputs are unwrapped, multi-value outputs are returned as tuple (like .call()).
+    """
+    results = []
+    for i in range(0, len(calls), BATCH_SIZE):
+        batch = calls[i:i+BATCH_SIZE]
+        payload = [(fn.address, True, fn._encode_transaction_data()) for fn in batch]
+        for fn in batch:
+            MULTICALL_CALLS.inc(function=fn.fn_name)
+        start = time.time()
+        response = multicall.functions.aggregate3(payload).call(block_identifier=block)
+        MULTICALL_LATENCY.observe(time.time() - start, batch="+".join(sorted({fn.fn_name for fn in batch})))
+        for fn, (success, returnData) in zip(batch, response):
+            if not success:
+                results.append(None)
+                continue
+            outputTypes = [o["type"] for o in fn.abi["outputs"]]
+            decoded = multicall.web3.codec.decode_abi(outputTypes, returnData)
+            # The codec returns lowercase addresses, .call() would return checksummed ones
+            decoded = [multicall.web3.toChecksumAddress(v) if t == "address" else v for t, v in zip(outputTypes, decoded)]
+            results.append(decoded[0] if len(decoded) == 1 else tuple(decoded))
+    return results
+
+def get_pool_snapshot(bonding_manager, multicall, block="latest", previous=()):
+    """Returns the transcoder pool at the given block as dict: address -> {"transcoder": getTranscoder(), "totalStake": int}
+
+    The pool is a linked list, so the next element can only be known once the current one is.
+    To avoid one request per element, the members of the previous snapshot are used as hint:
+    getNextTranscoderInPool, getTranscoder and transcoderTotalStake of all of them are fetched speculatively
+    in the same batch as the pool head. In the steady state (no pool changes) this is a single request,
+    every address that joined the pool since the previous snapshot costs one additional request.
+    """
+    fns = bonding_manager.functions
+    previous = list(previous)
+    head = aggregate(multicall, [fns.getFirstTranscoderInPool(), fns.getTranscoderPoolSize()]
+        + [fns.getNextTranscoderInPool(a) for a in previous]
+        + [fns.getTranscoder(a) for a in previous]
+        + [fns.transcoderTotalStake(a) for a in previous], block)
+    first, poolSize = head[0], head[1]
+    n = len(previous)
+    nextOf = dict(zip(previous, head[2:2+n]))
+    details = dict(zip(previous, head[2+n:2+2*n]))
+    stakes = dict(zip(previous, head[2+2*n:]))
+
+    pool = [first] if first != ZERO_ADDRESS else []
+    while pool and len(pool) < poolSize:
+        tail = pool[-1]
+        if nextOf.get(tail) is None:
+            # Not part of the previous snapshot -> fetch it on its own
+            nextOf[tail] = aggregate(multicall, [fns.getNextTranscoderInPool(tail)], block)[0]
+        if nextOf[tail] in (None, ZERO_ADDRESS):
+            break
+        pool.append(nextOf[tail])
+
+    missing = [a for a in pool if details.get(a) is None or stakes.get(a) is None]
+    if missing:
+        extra = aggregate(multicall, [fns.getTranscoder(a) for a in missing]
+            + [fns.transcoderTotalStake(a) for a in missing], block)
+        details.update(zip(missing, extra[:len(missing)]))
+        stakes.update(zip(missing, extra[len(missing):]))
+    return {a: {"transcoder": details[a], "totalStake": stakes[a]} for a in pool}
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+import heapq
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from setup import TEL_URL
+from metrics import Counter, Gauge, Histogram
+
+# Telegram limits: about 30 messages per second overall and 1 message per second to the same chat
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+# Failed messages are retried after retryDelay seconds, doubled with every attempt up to this many seconds
+MAX_RETRY_DELAY = 60
+# Maximum length of a telegram message
+MAX_MESSAGE_LENGTH = 4096
+
+QUEUE_DEPTH = Gauge("notifier_queue_depth", "Messages which are not delivered yet")
+SEND_LATENCY = Histogram("notifier_send_seconds", "Seconds from queueing a message until it was delivered")
+TELEGRAM_RESPONSES = Counter("telegram_responses_total", "Responses of the telegram sendMessage API per status code")
+
+def split_digest(texts, limit=MAX_MESSAGE_LENGTH):
+    """Joins the texts to as few messages as possible, each at most limit characters long
+    """
+    messages = []
+    current = ""
+    for text in texts:
+        for part in [text[i:i+limit] for i in range(0, len(text), limit)]:
+            if current and len(current) + 2 + len(part) > limit:
+                messages.append(current)
+                current = part
+            else:
+                current = current + "\n\n" + part if current else part
+    if current:
+        messages.append(current)
+    return messages
+
+class TokenBucket:
+    """Classic token bucket: rate tokens per second, up to capacity tokens can be spent at once
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until a token is available
+        """
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+class Notifier:
+    """Delivers telegram messages in the background.
+
+    send() only enqueues the message, so the watcher never waits on delivery.
+    add_digest() collects the messages of a processing window per chat until flush_digests() sends them as one message per chat,
+    urgent ones on their own and first.
+    A scheduler thread applies the global and per-chat rate limits and hands the messages to a small pool of sender threads
+    which share one HTTP session. Messages to the same chat keep their order. On a 429 response the message is retried
+    after the retry_after period Telegram asks for, after connection errors, timeouts and 5xx responses with an exponential
+    backoff, up to maxRetries times. Messages Telegram rejects with another 4xx are dropped.
+
+    With an outbox store, flush_digests() writes the messages to the outbox (inside the caller's transaction) and release()
+    queues them once that transaction is committed. They are deleted when delivered (or rejected), start() queues the ones
+    which were not delivered before the last shutdown, also the ones given up on after maxRetries.
+    """
+
+    def __init__(self, url=TEL_URL, globalRate=GLOBAL_RATE, chatRate=CHAT_RATE, senders=4, maxRetries=5, retryDelay=2, outbox=None):
+        self.url = url
+        self.outbox = outbox
+        self.globalBucket = TokenBucket(globalRate)
+        self.chatRate = chatRate
+        self.maxRetries = maxRetries
+        self.retryDelay = retryDelay
+        self.session = requests.Session()
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=senders))
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=senders))
+        self.executor = ThreadPoolExecutor(max_workers=senders)
+        self.inbox = queue.Queue()
+        self.chats = {} # chat_id -> deque of (text, retries, queued, outbox id)
+        self.chatBuckets = {}
+        self.inFlight = set()
+        self.ready = [] # heap of (time, chat_id) of chats with pending messages
+        self.pausedUntil = 0
+        self.pending = 0
+        self.lock = threading.Condition()
+        self.digests = {} # chat_id -> list of texts waiting for flush_digests()
+        self.urgent = [] # (text, chat_id) waiting for flush_digests(), sent as they are
+        self.staged = [] # (outbox id, text, chat_id) waiting for release()
+        self.thread = None
+
+    def start(self):
+        if not self.thread:
+            if self.outbox:
+                for id, text, chat_id in self.outbox.get_outbox():
+                    self.send(text, chat_id, id)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def send(self, text, chat_id, id=None):
+        """Queues the message for delivery, id is its row in the outbox
+        """
+        with self.lock:
+            self.pending += 1
+            QUEUE_DEPTH.set(self.pending)
+        self.inbox.put((text, chat_id, time.time(), id))
+
+    def add_digest(self, text, chat_id, urgent=False):
+        """Collects the message for the next digest of the chat, urgent messages are not joined with the others
+        """
+        with self.lock:
+            if urgent:
+                self.urgent.append((text, chat_id))
+            else:
+                self.digests.setdefault(chat_id, []).append(text)
+
+    def flush_digests(self):
+        """Queues the collected messages, the urgent ones first, the others joined to one message per chat
+        (split if longer than telegram allows)
+        """
+        with self.lock:
+            digests, self.digests = self.digests, {}
+            urgent, self.urgent = self.urgent, []
+        messages = urgent + [(message, chat_id) for chat_id, texts in digests.items() for message in split_digest(texts)]
+        if not self.outbox:
+            for text, chat_id in messages:
+                self.send(text, chat_id)
+            return
+        ids = self.outbox.add_outbox(messages)
+        with self.lock:
+            self.staged.extend((id, text, chat_id) for id, (text, chat_id) in zip(ids, messages))
+
+    def release(self):
+        """Queues the messages flush_digests() wrote to the outbox, once they are committed
+        """
+        with self.lock:
+            staged, self.staged = self.staged, []
+        for id, text, chat_id in staged:
+            self.send(text, chat_id, id)
+
+    def discard_digests(self):
+        """Drops the collected messages, also the ones written to the outbox by a transaction which was rolled back
+        """
+        with self.lock:
+            self.digests = {}
+            self.urgent = []
+            self.staged = []
+
+    def qsize(self):
+        """Number of messages which are not delivered yet
+        """
+        return self.pending
+
+    def join(self, timeout=None):
+        """Waits until all queued messages are delivered (or dropped)
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while self.pending:
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def _schedule(self, chat_id, at):
+        # Caller holds the lock
+        heapq.heappush(self.ready, (at, chat_id))
+
+    def _run(self):
+        while True:
+            # Wait for new messages, but not longer than until the next chat is allowed to send
+            with self.lock:
+                timeout = max(0, self.ready[0][0] - time.monotonic()) if self.ready else None
+            try:
+                item = self.inbox.get(timeout=timeout)
+                while True:
+                    # None only wakes up the scheduler
+                    if item:
+                        self._accept(*item)
+                    item = self.inbox.get_nowait()
+            except queue.Empty:
+                pass
+            self._dispatch()
+
+    def _accept(self, text, chat_id, queued, id):
+        with self.lock:
+            messages = self.chats.setdefault(chat_id, deque())
+            if not messages and chat_id not in self.inFlight:
+                self._schedule(chat_id, time.monotonic())
+            messages.append((text, 0, queued, id))
+
+    def _dispatch(self):
+        while True:
+            with self.lock:
+                if not self.ready or self.ready[0][0] > time.monotonic():
+                    return
+                wait = max(self.pausedUntil - time.monotonic(), self.globalBucket.wait_time())
+                if wait <= 0:
+                    at, chat_id = heapq.heappop(self.ready)
+                    if chat_id in self.inFlight or not self.chats.get(chat_id):
+                        continue
+                    bucket = self.chatBuckets.setdefault(chat_id, TokenBucket(self.chatRate, 1))
+                    chatWait = bucket.wait_time()
+                    if chatWait > 0:
+                        self._schedule(chat_id, time.monotonic() + chatWait)
+                        continue
+                    text, retries, queued, id = self.chats[chat_id].popleft()
+                    if not self.chats[chat_id]:
+                        del self.chats[chat_id]
+                    bucket.take()
+                    self.globalBucket.take()
+                    self.inFlight.add(chat_id)
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            self.executor.submit(self._deliver, text, chat_id, retries, queued, id)
+
+    def retry_delay(self, retries):
+        """Seconds before a message which failed retries times is sent again
+        """
+        return min(MAX_RETRY_DELAY, self.retryDelay * 2 ** retries)
+
+    def _deliver(self, text, chat_id, retries, queued, id):
+        # Seconds until the message is sent again, None once it is delivered or rejected
+        retryAfter = None
+        flood = False
+        try:
+            r = self.session.post(self.url + "sendMessage", data={"text": text, "chat_id": chat_id, "parse_mode": "markdown"}, timeout=30)
+            TELEGRAM_RESPONSES.inc(code=r.status_code)
+            if r.status_code == 429:
+                retryAfter = r.json().get("parameters", {}).get("retry_after", 1)
+                flood = True
+            elif r.status_code >= 500:
+                print("Telegram error {} for chat {}: {}".format(r.status_code, chat_id, r.text))
+                retryAfter = self.retry_delay(retries)
+            elif not r.ok:
+                # Rejected (blocked bot, unknown chat, invalid markdown), sending it again would fail the same way
+                print("Telegram error {} for chat {}: {}".format(r.status_code, chat_id, r.text))
+        except Exception as ex:
+            TELEGRAM_RESPONSES.inc(code="exception")
+            print(ex)
+            retryAfter = self.retry_delay(retries)
+        retry = retryAfter is not None and retries < self.maxRetries
+        if retryAfter is not None and not retry:
+            print("Giving up on a message for chat {} after {} attempts{}".format(chat_id, retries + 1, ", kept in the outbox" if id is not None else ""))
+        elif retryAfter is None and id is not None:
+            try:
+                self.outbox.remove_outbox(id)
+            except Exception as ex:
+                # Sent again after a restart
+                print(ex)
+        with self.lock:
+            self.inFlight.discard(chat_id)
+            if retry:
+                if flood:
+                    # Flood control applies to the whole bot
+                    self.pausedUntil = max(self.pausedUntil, time.monotonic() + retryAfter)
+                # Retried messages go first to keep the order within the chat
+                self.chats.setdefault(chat_id, deque()).appendleft((text, retries + 1, queued, id))
+            else:
+                self.pending -= 1
+                QUEUE_DEPTH.set(self.pending)
+                SEND_LATENCY.observe(time.time() - queued)
+                self.lock.notify_all()
+            if self.chats.get(chat_id):
+                self._schedule(chat_id, time.monotonic() + (retryAfter if retry and not flood else 0))
+        # Wake up the scheduler
+        self.inbox.put(None)
@@ -1,20 +1,65 @@
 #!/usr/bin/env python3
 
 import web3
+import atexit
 import json
+import queue
+import sys
 import time
 import requests
+from hexbytes import HexBytes
 from web3 import Web3
-from setup import WS_ARBITRUM_ALCHEMY, WS_MAINNET_INFURA, MY_TELEGRAM_ID, send_message, BONDING_MANAGER_PROXY, BONDING_MANAGER_ABI, ROUND_MANAGER_PROXY, ROUND_MANAGER_ABI, TICKET_BROKER_PROXY
+from web3.datastructures import AttributeDict
+from setup import ARBITRUM_ENDPOINTS, MAINNET_ENDPOINTS, MY_TELEGRAM_ID, send_message, BONDING_MANAGER_PROXY, BONDING_MANAGER_ABI, ROUND_MANAGER_PROXY, ROUND_MANAGER_ABI, TICKET_BROKER_PROXY
+from multicall import get_multicall, get_pool_snapshot
+from logscan import ChunkSizer, iter_chunks
+from notifier import Notifier
+from cache import ReadCache
+from store import Store, log_key
+from stream import LogStream
+from rpcpool import ProviderPool, set_budget_share
+from sharding import HashRing, ShardPool
+from schedule import RoundSchedule, TimerWheel
+from metrics import Counter, Gauge, Histogram, function_selectors, rpc_metrics_middleware, start_server
 
-w3 = Web3(Web3.WebsocketProvider(WS_ARBITRUM_ALCHEMY))
-w3m = Web3(Web3.WebsocketProvider(WS_MAINNET_INFURA))
+# Every connection spreads its requests over the endpoints of its chain, with failover and hedging
+w3 = Web3(ProviderPool(ARBITRUM_ENDPOINTS))
+w3m = Web3(ProviderPool(MAINNET_ENDPOINTS))
+# Separate connections for eth_getLogs, so the next block range can be prefetched while the handlers run
+w3logs = Web3(ProviderPool(ARBITRUM_ENDPOINTS))
+# Health checks are started by main()/main_stream()
+providerPools = [w3.provider, w3m.provider, w3logs.provider]
+# Streaming mode subscribes over the websocket endpoints, without any the watcher polls
+stream_urls = [url for url, rate in ARBITRUM_ENDPOINTS if url.startswith("ws")]
 
 ###
 # Variables
 ###
 
 poll_interval = 300
+# Reward call warnings are sent once these shares of the round (in mainnet blocks) passed without a reward call
+reward_deadlines = (0.5, 0.8, 0.95)
+# Seconds per mainnet block, to wake up at the next reward deadline
+mainnet_block_time = 12
+# Streaming mode: buffered logs are committed at least this often (seconds) to advance the checkpoint
+stream_flush_interval = 10
+# Only blocks with at least this many blocks on top are processed
+confirmations = 0
+# Processed blocks which are scanned again in every cycle, events which disappeared from them (reorg) are rolled back
+reorg_depth = 100
+# Processed events are remembered for this many blocks (at least reorg_depth), so overlapping scans never handle an event twice
+processed_logs_kept = 100000
+# Block range of a single eth_getLogs request, adapted to the provider limits and response times
+chunkSizer = ChunkSizer(size=2000, maxSize=100000)
+# Prometheus metrics are served on http://127.0.0.1:<metrics_port>/metrics
+metrics_port = 9101
+# Shard i (--shards) serves its metrics on shard_metrics_port + i, away from the port of telegram-subscriptions.py
+shard_metrics_port = 9110
+# Print the duration of the processing phases after every cycle
+profile = "--profile" in sys.argv
+# Share of the endpoint request budgets this script uses, the rest is left to telegram-subscriptions.py.
+# With --shards it is split evenly between the coordinator and the shard processes
+rpc_budget_share = 0.9
 
 ###
 # Contracts, Filters & Classes
@@ -22,11 +67,41 @@ poll_interval = 300
 
 bonding_manager_proxy = w3.eth.contract(address=BONDING_MANAGER_PROXY, abi=json.loads(BONDING_MANAGER_ABI))
 round_manager_proxy = w3.eth.contract(address=ROUND_MANAGER_PROXY, abi=json.loads(ROUND_MANAGER_ABI))
+multicall = get_multicall(w3)
+# Contract reads inside one processing window, prefetched before the store transaction and cleared after every scanned chunk
+readCache = ReadCache()
+# Subscriptions and the event index, shared with telegram-subscriptions.py
+sharedStore = Store()
+# Checkpoints, processed logs, ticket accumulators, transcoder flags and the notification outbox (a shard keeps them in its own file)
+store = sharedStore
+# Outgoing subscriber notifications are delivered in the background, respecting the telegram rate limits.
+# They are written to the outbox together with the processed window and released once it is committed:
+# reward/fee cut changes on their own, all others as one digest per chat
+notifier = Notifier(outbox=store)
+# Sharded mode (--shards N): the coordinator scans the logs and hands the events to the shard processes (see run_shard())
+shardPool = None
+# Set in a shard process: the orchestrators it is responsible for
+shardIndex = None
+shardRing = None
+
+# Metrics
+selectors = function_selectors(bonding_manager_proxy, round_manager_proxy, multicall)
+for connection in (w3, w3m, w3logs):
+    connection.middleware_onion.add(rpc_metrics_middleware(selectors))
+EVENTS = Counter("watcher_events_total", "Processed events per handler")
+BLOCK_LAG = Gauge("watcher_block_lag", "Arbitrum blocks between the chain head and the last processed block")
+REORGED_EVENTS = Counter("watcher_reorged_events_total", "Processed events which were rolled back after a reorg")
+LATE_LOGS = Counter("watcher_late_logs_total", "Streamed logs which arrived after their block was committed, handled by the next scan")
+PHASE_TIME = Histogram("watcher_phase_seconds", "Duration of the processing phases")
+Gauge("watcher_read_cache_hits", "Contract reads answered by the read cache", function=lambda: readCache.hits)
+Gauge("watcher_read_cache_misses", "Contract reads which needed an RPC request", function=lambda: readCache.misses)
 
 class Transcoder:
-    # Class Attributes, defaults to true in case script crashes -> no invalid warnings
+    # Class Attributes, defaults to true for transcoders without stored flags -> no invalid warnings
     rewardCalled = True
     isActive = True
+    # (rewardCalled, isActive) as stored, None if not stored yet
+    storedFlags = None
 
     def __init__(self, address, subscriber=[]):
         self.address = address
@@ -41,122 +116,158 @@ class ErrorMessage:
 # Functions
 ###
 
+def owns(address):
+    """Checks if this process is responsible for the orchestrator (always true unless it is a shard)
+    """
+    return shardRing is None or shardRing.shard(address) == shardIndex
+
 def update_transcoder_instances():
-    """Reads the subscription file and updates the transcoder dict.
-    """
-    with open("transcoder_subscriptions.json", "r") as f: 
-        ts = json.load(f)
-    # Without resetting the dict (and losing updated variables like .rewardCalled), remove the transcoders that are no longer in the subscriber list
-    noLongerInList = list(set(transcoder.keys()).difference(ts.keys()))
-    for addr in noLongerInList:
-        del transcoder[addr]
-    for address, subscriber in ts.items():
-        if address not in transcoder.keys():
-            transcoder[address] = Transcoder(address, subscriber)
-        else:
-            setattr(transcoder[address], "subscriber", subscriber)
+    """Applies the subscription changes since the last call to the transcoder dict.
+    
+    Only reads the (indexed) subscription version if nothing changed, reloads everything if the changes are no longer available.
+    A shard only keeps the orchestrators it owns.
+    """
+    global subscriptionsVersion
+    version, changes = sharedStore.get_subscription_changes(subscriptionsVersion)
+    if changes is None:
+        version, ts = sharedStore.get_subscriptions()
+        ts = {address: subscriber for address, subscriber in ts.items() if owns(address)}
+        # Without resetting the dict (and losing updated variables like .rewardCalled), remove the transcoders that are no longer in the subscriber list
+        noLongerInList = list(set(transcoder.keys()).difference(ts.keys()))
+        for addr in noLongerInList:
+            drop_transcoder(addr)
+        for address, subscriber in ts.items():
+            if address not in transcoder.keys():
+                transcoder[address] = Transcoder(address, subscriber)
+                load_transcoder_flags(transcoder[address])
+            else:
+                setattr(transcoder[address], "subscriber", subscriber)
+    else:
+        for address, chat_id, added in changes:
+            if not owns(address):
+                continue
+            if added:
+                if address not in transcoder.keys():
+                    transcoder[address] = Transcoder(address, [])
+                    load_transcoder_flags(transcoder[address])
+                if chat_id not in transcoder[address].subscriber:
+                    transcoder[address].subscriber.append(chat_id)
+            elif address in transcoder.keys():
+                if chat_id in transcoder[address].subscriber:
+                    transcoder[address].subscriber.remove(chat_id)
+                if not transcoder[address].subscriber:
+                    drop_transcoder(address)
+    subscriptionsVersion = version
 
-def get_active_transcoders():
-    """Gets all the active transcoders in the Livepeer Pool
+def drop_transcoder(address):
+    """Removes the transcoder from the dict, its stored flags are deleted with the next commit since they are not kept up to date anymore
     """
-    first = bonding_manager_proxy.functions.getFirstTranscoderInPool().call()
-    transcoderPoolSize = bonding_manager_proxy.functions.getTranscoderPoolSize().call()
-    activeTranscoders = [first]
-    for i in range(0, transcoderPoolSize-1):
-        activeTranscoders.append(bonding_manager_proxy.functions.getNextTranscoderInPool(activeTranscoders[i]).call())
+    del transcoder[address]
+    droppedTranscoders.add(address)
+
+def load_transcoder_flags(t):
+    """Restores rewardCalled/isActive of the transcoder from the store, unless it was dropped since the last commit (outdated flags)
+    """
+    if t.address in droppedTranscoders:
+        droppedTranscoders.discard(t.address)
+        t.storedFlags = None
+        return
+    flags = store.get_transcoder_flags(t.address)
+    if flags:
+        t.rewardCalled, t.isActive = flags
+    t.storedFlags = flags
+
+def get_active_transcoders(block="latest"):
+    """Gets all the active transcoders in the Livepeer Pool at the given block
+    
+    Returns a dict address -> {"transcoder": getTranscoder(), "totalStake": transcoderTotalStake()}.
+    The previous snapshot is passed as hint so the pool is usually fetched with a single multicall.
+    After a restart (and in a new shard) the stored active set of the last round, or the subscribed orchestrators, are the hint.
+    Snapshots prefetched before the store transaction are used as they are.
+    """
+    global activeTranscoders
+    if block not in poolSnapshots:
+        read_pool_snapshot(block)
+    activeTranscoders = poolSnapshots.pop(block)
     return activeTranscoders
 
-def process_round():
+def read_pool_snapshot(block):
+    hint = list(activeTranscoders) or sharedStore.get_last_active_transcoders() or list(transcoder)
+    poolSnapshots[block] = get_pool_snapshot(bonding_manager_proxy, multicall, block, hint)
+
+def process_round(block="latest"):
     """After a new round has begun, check for missed reward calls.
     
     Also checks if the transcoder became active/inactive.
     """
-    activeTranscoders = get_active_transcoders()
+    activeTranscoders = get_active_transcoders(block)
+    sharedStore.add_active_transcoders(roundNrOld, activeTranscoders.keys())
     for address in transcoder:
         if (transcoder[address].rewardCalled == False and transcoder[address].isActive == True):
             for chat_id in transcoder[address].subscriber:
-                send_message("NO REWARDS CLAIMED - Orchestrator {} did not claim the rewards in the last round! You did not get any rewards for your stake.".format(address[:8]+"..."), chat_id)
-                time.sleep(1.5)
+                notifier.add_digest("NO REWARDS CLAIMED - Orchestrator {} did not claim the rewards in the last round! You did not get any rewards for your stake.".format(address[:8]+"..."), chat_id)
         transcoder[address].rewardCalled = False
         if address not in activeTranscoders:
             transcoder[address].isActive = False
             for chat_id in transcoder[address].subscriber:
-                send_message("WARNING - Orchestrator {} is no longer in the active orchestrator set! You will no longer receive rewards for your stake.".format(address[:8]+"..."), chat_id)
-                time.sleep(1.5)
+                notifier.add_digest("WARNING - Orchestrator {} is no longer in the active orchestrator set! You will no longer receive rewards for your stake.".format(address[:8]+"..."), chat_id)
         elif transcoder[address].isActive == False and address in activeTranscoders:
             transcoder[address].isActive = True
             for chat_id in transcoder[address].subscriber:
-                send_message("Orchestrator {} is back in the active orchestrator set! You will get notified if and when rewards are called.".format(address[:8]+"..."), chat_id)
-                time.sleep(1.5)
+                notifier.add_digest("Orchestrator {} is back in the active orchestrator set! You will get notified if and when rewards are called.".format(address[:8]+"..."), chat_id)
 
-def check_rewardCut_changes(fromBlock, toBlock):
-    """Checks for changes in the reward & fee cut values between fromBlock and toBlock.
+def check_rewardCut_changes(event):
+    """Handles a TranscoderUpdate event (changes in the reward & fee cut values).
     
-    If an event exists, get the caller of the event and check if it is in the subscription list.
+    Get the caller of the event and check if it is in the subscription list.
     Get the new and old fee and reward cut values and check if either one changed.
     Send notification to the subscribers.
     """
+    caller = w3.toChecksumAddress("0x" + event["topics"][1].hex()[26:])
+    if caller in transcoder.keys():
+        rewardCut = w3.toInt(hexstr=event["data"][2:][:64])
+        feeShare = w3.toInt(hexstr=event["data"][2:][64:])
+        roundNr = readCache.call(round_manager_proxy.functions.currentRound())
+        previousData = readCache.call(bonding_manager_proxy.functions.getTranscoderEarningsPoolForRound(caller, roundNr))
+        pRewardCut = previousData[1]
+        pFeeShare = previousData[2]
+        tx = event["transactionHash"].hex()
+        if rewardCut != pRewardCut or feeShare != pFeeShare:     
+            message = "REWARD AND/OR FEE CUT CHANGE - for Orchestrator {caller}!\n\n" \
+                "New values:\nReward cut = {rewardCut} (old: {pRewardCut})\n" \
+                "Fee cut = {feeCut} (old: {pFeeCut})\n" \
+                "[Transaction link](https://arbiscan.io/tx/{tx})".format(
+                    caller = caller[:8]+"...", rewardCut = str(rewardCut/10**4)+"%",
+                    pRewardCut = str(pRewardCut/10**4)+"%", feeCut = str(100-(feeShare/10**4))+"%", 
+                    pFeeCut = str(100-(pFeeShare/10**4))+"%", tx = tx)
+            for chat_id in transcoder[caller].subscriber:
+                notifier.add_digest(message, chat_id, urgent=True)
+
+def check_rewardCall(event):
+    """Handles a Reward event.
     
-    rewardCut_filter = w3.eth.filter({
-    "fromBlock": fromBlock,
-    "toBlock": toBlock,
-    "address": BONDING_MANAGER_PROXY,
-    "topics": ['0x7346854431dbb3eb8e373c604abf89e90f4865b8447e1e2834d7b3e4677bf544'],
-    })
-    for event in rewardCut_filter.get_all_entries():
-        caller = w3.toChecksumAddress("0x" + event["topics"][1].hex()[26:])
-        if caller in transcoder.keys():
-            rewardCut = w3.toInt(hexstr=event["data"][2:][:64])
-            feeShare = w3.toInt(hexstr=event["data"][2:][64:])
-            roundNr = round_manager_proxy.functions.currentRound().call()
-            previousData = bonding_manager_proxy.functions.getTranscoderEarningsPoolForRound(caller, roundNr).call()
-            pRewardCut = previousData[1]
-            pFeeShare = previousData[2]
-            tx = event["transactionHash"].hex()
-            if rewardCut != pRewardCut or feeShare != pFeeShare:     
-                message = "REWARD AND/OR FEE CUT CHANGE - for Orchestrator {caller}!\n\n" \
-                    "New values:\nReward cut = {rewardCut} (old: {pRewardCut})\n" \
-                    "Fee cut = {feeCut} (old: {pFeeCut})\n" \
-                    "[Transaction link](https://arbiscan.io/tx/{tx})".format(
-                        caller = caller[:8]+"...", rewardCut = str(rewardCut/10**4)+"%",
-                        pRewardCut = str(pRewardCut/10**4)+"%", feeCut = str(100-(feeShare/10**4))+"%", 
-                        pFeeCut = str(100-(pFeeShare/10**4))+"%", tx = tx)
-                for chat_id in transcoder[caller].subscriber:
-                    send_message(message, chat_id)
-                    time.sleep(1.5)
-
-def check_rewardCall(fromBlock, toBlock):
-    """Checks for reward transactions between blockOld and block.
-    
-    If an event exists, get the caller of the event and check if it is in the subscription list.
+    Get the caller of the event and check if it is in the subscription list.
     Sends notification to the subscribers and sets the rewardCalled attribute for the caller to true.
+    Reward calls of all orchestrators are added to the event index.
     """
-
-    rewardCall_filter = w3.eth.filter({
-    "fromBlock": fromBlock,
-    "toBlock": toBlock,
-    "address": BONDING_MANAGER_PROXY,
-    "topics": ['0x619caafabdd75649b302ba8419e48cccf64f37f1983ac4727cfb38b57703ffc9'],
-    })
-    for event in rewardCall_filter.get_all_entries():
-        caller = w3.toChecksumAddress("0x" + event["topics"][1].hex()[26:])
-        if caller in transcoder.keys() and transcoder[caller].rewardCalled == False:
-            tokens = round(w3.toInt(hexstr=event["data"])/10**18,2)
-            roundNr = round_manager_proxy.functions.currentRound().call()
-            data = bonding_manager_proxy.functions.getTranscoderEarningsPoolForRound(caller, roundNr).call()
-            totalStake = round(data[0]/10**18)
-            rewardCut = data[1]/10**4
-            rewardCutTokens = round(tokens*(rewardCut/10**2),2)
-            tx = event["transactionHash"].hex()
-            message = "Rewards claimed for round {roundNr} -> Orchestrator {caller} received {tokens} LPT " \
-                "for a total stake of {totalStake} LPT (keeping {rewardCutTokens} LPT due to its {rewardCut} reward cut)\n" \
-                "[Transaction link](https://arbiscan.io/tx/{tx})".format(
-                roundNr = roundNr, caller = caller[:8]+"...", tokens = tokens, totalStake = totalStake,
-                rewardCutTokens = rewardCutTokens, rewardCut = str(rewardCut)+"%", tx = tx)
-            for chat_id in transcoder[caller].subscriber:
-                send_message(message, chat_id)
-                time.sleep(1.5)
-            transcoder[caller].rewardCalled = True
+    caller = w3.toChecksumAddress("0x" + event["topics"][1].hex()[26:])
+    sharedStore.add_reward_call(*event_key(event), roundNrOld, caller, event["blockNumber"], w3.toInt(hexstr=event["data"])/10**18)
+    if caller in transcoder.keys() and transcoder[caller].rewardCalled == False:
+        tokens = round(w3.toInt(hexstr=event["data"])/10**18,2)
+        roundNr = readCache.call(round_manager_proxy.functions.currentRound())
+        data = readCache.call(bonding_manager_proxy.functions.getTranscoderEarningsPoolForRound(caller, roundNr))
+        totalStake = round(data[0]/10**18)
+        rewardCut = data[1]/10**4
+        rewardCutTokens = round(tokens*(rewardCut/10**2),2)
+        tx = event["transactionHash"].hex()
+        message = "Rewards claimed for round {roundNr} -> Orchestrator {caller} received {tokens} LPT " \
+            "for a total stake of {totalStake} LPT (keeping {rewardCutTokens} LPT due to its {rewardCut} reward cut)\n" \
+            "[Transaction link](https://arbiscan.io/tx/{tx})".format(
+            roundNr = roundNr, caller = caller[:8]+"...", tokens = tokens, totalStake = totalStake,
+            rewardCutTokens = rewardCutTokens, rewardCut = str(rewardCut)+"%", tx = tx)
+        for chat_id in transcoder[caller].subscriber:
+            notifier.add_digest(message, chat_id)
+        transcoder[caller].rewardCalled = True
 
 def check_rewardCall_status(block):
     """Sends a notification if a transcoder didn't call reward yet but is in the active set
@@ -164,72 +275,305 @@ def check_rewardCall_status(block):
     for address in transcoder.keys():
         if transcoder[address].rewardCalled == False and transcoder[address].isActive == True:
             for chat_id in transcoder[address].subscriber:
-                send_message("WARNING - Orchestrator {} did not yet claim rewards at block {} of 6377 in the current round!".format(address[:8]+"...", str((block-15696000)%6377)), chat_id)
-                time.sleep(1.5)
+                notifier.add_digest("WARNING - Orchestrator {} did not yet claim rewards at block {} of {} in the current round!".format(
+                    address[:8]+"...", roundSchedule.progress(block), roundSchedule.length), chat_id)
 
-def check_ticketRedemption(fromBlock, toBlock):
-    """Checks for ticket redemptions between blockOld and block.
+def check_ticketRedemption(event):
+    """Handles a WinningTicketRedeemed event.
     
-    If an event exists, get the caller of the event and check if it is in the subscription list.
+    Get the recipient of the ticket and check if it is in the subscription list.
     Sends notification to the subscribers.
+    Tickets of all orchestrators are added to the event index.
     """
-    ticket_filter = w3.eth.filter({
-    "fromBlock": fromBlock,
-    "toBlock": toBlock,
-    "address": TICKET_BROKER_PROXY,
-    "topics": ['0x8b87351a208c06e3ceee59d80725fd77a23b4129e1b51ca231fc89b40712649c']})
-    for event in ticket_filter.get_all_entries():
-        caller = w3.toChecksumAddress("0x" + event["topics"][2].hex()[26:])
-        if caller in transcoder.keys():
-            ticketValue = round(w3.toInt(hexstr=event["data"])/10**18, 4)
-            feeShare = bonding_manager_proxy.functions.getTranscoder(caller).call()[2]/10**6
-            ticketShare = round(ticketValue*feeShare, 4)
-            with open("winning_tickets.json") as f:
-                wt = json.load(f)
-            if wt.get(caller):
-                wt[caller]["value"].append(ticketValue)
-                wt[caller]["share"].append(ticketShare)
-            else:
-                wt[caller] = {'value': [ticketValue], 'share': [ticketShare]}
-            stake = round(bonding_manager_proxy.functions.transcoderTotalStake(caller).call()/10**18,-5)
-            roundedStake = round(stake, -5)
-            if roundedStake == 0:
-                LIMIT = 0.01
-            elif roundedStake >= 1000000:
-                LIMIT = 0.1
-            else:
-                LIMIT = roundedStake/10**7
-            if sum(wt[caller]["value"]) > LIMIT:
-                message = "Since the last payout notification, Orchestrator {caller_short} earned {ticketValue} ETH for transcoding!\n" \
-                "Out of those, its delegators share {ticketShare} ETH. The Orchestrator's current fee cut is {feeCut}%\n" \
-                "[Check arbiscan for the txs](https://arbiscan.io/address/{caller})".format(
-                    caller_short = caller[:8]+"...", ticketValue = round(sum(wt[caller]["value"]), 3), 
-                    ticketShare = round(sum(wt[caller]["share"]), 3), feeCut = round((1-feeShare)*100), caller = caller)
-                for chat_id in transcoder[caller].subscriber:
-                    send_message(message, chat_id)
-                    time.sleep(1.5)
-                #delete values if messages were sent
-                wt[caller]["value"], wt[caller]["share"] = [], []
-            #save file
-            with open("winning_tickets.json", "w") as f:
-                json.dump(wt, f, indent=1)
-
-def check_round_change(fromBlock, toBlock):
-    """Checks for round initilized txs between blockOld and block.
+    caller = w3.toChecksumAddress("0x" + event["topics"][2].hex()[26:])
+    sharedStore.add_ticket_redemption(*event_key(event), roundNrOld, caller, event["blockNumber"], w3.toInt(hexstr=event["data"])/10**18)
+    if caller in transcoder.keys():
+        ticketValue = round(w3.toInt(hexstr=event["data"])/10**18, 4)
+        feeShare = readCache.call(bonding_manager_proxy.functions.getTranscoder(caller))[2]/10**6
+        ticketShare = round(ticketValue*feeShare, 4)
+        sumValue, sumShare = store.add_ticket(caller, event["blockNumber"], ticketValue, ticketShare, *event_key(event))
+        stake = round(readCache.call(bonding_manager_proxy.functions.transcoderTotalStake(caller))/10**18,-5)
+        roundedStake = round(stake, -5)
+        if roundedStake == 0:
+            LIMIT = 0.01
+        elif roundedStake >= 1000000:
+            LIMIT = 0.1
+        else:
+            LIMIT = roundedStake/10**7
+        if sumValue > LIMIT:
+            message = "Since the last payout notification, Orchestrator {caller_short} earned {ticketValue} ETH for transcoding!\n" \
+            "Out of those, its delegators share {ticketShare} ETH. The Orchestrator's current fee cut is {feeCut}%\n" \
+            "[Check arbiscan for the txs](https://arbiscan.io/address/{caller})".format(
+                caller_short = caller[:8]+"...", ticketValue = round(sumValue, 3), 
+                ticketShare = round(sumShare, 3), feeCut = round((1-feeShare)*100), caller = caller)
+            for chat_id in transcoder[caller].subscriber:
+                notifier.add_digest(message, chat_id)
+            #delete values if messages were sent
+            store.clear_tickets(caller)
+
+def check_round_change(event):
+    """Handles a NewRound event.
+    
+    If the round is newer than the last processed one, store the round, load the schedule of the new round and process the previous round.
+    Since the logs are dispatched in block/log index order, all events before the NewRound event
+    were already attributed to the previous round.
+    """
+    global roundNrOld, mainnetBlockOld
+    roundNr = w3.toInt(event["topics"][1])
+    if roundNr <= roundNrOld:
+        return
+    roundNrOld = roundNr
+    # The reward deadlines of the new round are counted from its start
+    mainnetBlockOld = load_round_schedule().start
+    # Committed together with the rest of the processed block range
+    store.set_checkpoint("mainnetBlock", mainnetBlockOld)
+    store.set_checkpoint("roundNr", roundNrOld)
+    process_round(event["blockNumber"])
+    print("processed round at block {}".format(str(event["blockNumber"])))
+
+def undo_rewardCall(event):
+    """Rolls back a Reward event which was removed in a reorg.
+
+    The reward is only no longer called if the event belonged to the current round, the reorg window can reach
+    into the previous one.
+    """
+    caller = w3.toChecksumAddress("0x" + event["topics"][1].hex()[26:])
+    round = sharedStore.remove_indexed_event(*event_key(event))
+    if caller in transcoder.keys() and round == roundNrOld:
+        transcoder[caller].rewardCalled = False
+
+def undo_ticketRedemption(event):
+    """Rolls back a WinningTicketRedeemed event which was removed in a reorg.
+    
+    Nothing to do if the ticket was already part of a payout notification.
+    """
+    sharedStore.remove_indexed_event(*event_key(event))
+    store.remove_ticket(*event_key(event))
+
+def read_rewardCut_changes(event):
+    caller = w3.toChecksumAddress("0x" + event["topics"][1].hex()[26:])
+    if caller not in transcoder.keys():
+        return []
+    roundNr = readCache.call(round_manager_proxy.functions.currentRound())
+    return [bonding_manager_proxy.functions.getTranscoderEarningsPoolForRound(caller, roundNr)]
+
+def read_rewardCall(event):
+    # rewardCalled may still be reset by a round change in the same window
+    return read_rewardCut_changes(event)
+
+def read_ticketRedemption(event):
+    caller = w3.toChecksumAddress("0x" + event["topics"][2].hex()[26:])
+    if caller not in transcoder.keys():
+        return []
+    return [bonding_manager_proxy.functions.getTranscoder(caller), bonding_manager_proxy.functions.transcoderTotalStake(caller)]
+
+def read_round_change(event):
+    """The pool at the block of the round change and the schedule of the new round
+    """
+    if w3.toInt(event["topics"][1]) <= roundNrOld:
+        return []
+    read_pool_snapshot(event["blockNumber"])
+    return round_schedule_calls()
+
+###
+# Log scan
+###
+
+# Dispatch table: event topic -> (emitting contract, handler)
+event_handlers = {
+    '0x22f2fc17c5daf07db2379b3a03a8ef20a183f761097a58fce219c8a14619e786': (ROUND_MANAGER_PROXY, check_round_change), # NewRound
+    '0x7346854431dbb3eb8e373c604abf89e90f4865b8447e1e2834d7b3e4677bf544': (BONDING_MANAGER_PROXY, check_rewardCut_changes), # TranscoderUpdate
+    '0x619caafabdd75649b302ba8419e48cccf64f37f1983ac4727cfb38b57703ffc9': (BONDING_MANAGER_PROXY, check_rewardCall), # Reward
+    '0x8b87351a208c06e3ceee59d80725fd77a23b4129e1b51ca231fc89b40712649c': (TICKET_BROKER_PROXY, check_ticketRedemption), # WinningTicketRedeemed
+}
+
+# Event topic -> index of the topic with the orchestrator address, the shards get the events of their orchestrators (and all other events)
+event_orchestrator_topic = {
+    '0x7346854431dbb3eb8e373c604abf89e90f4865b8447e1e2834d7b3e4677bf544': 1, # TranscoderUpdate
+    '0x619caafabdd75649b302ba8419e48cccf64f37f1983ac4727cfb38b57703ffc9': 1, # Reward
+    '0x8b87351a208c06e3ceee59d80725fd77a23b4129e1b51ca231fc89b40712649c': 2, # WinningTicketRedeemed
+}
+
+# Event topic -> function returning the contract reads the handler of a new event needs, see prefetch_reads()
+read_handlers = {
+    '0x22f2fc17c5daf07db2379b3a03a8ef20a183f761097a58fce219c8a14619e786': read_round_change, # NewRound
+    '0x7346854431dbb3eb8e373c604abf89e90f4865b8447e1e2834d7b3e4677bf544': read_rewardCut_changes, # TranscoderUpdate
+    '0x619caafabdd75649b302ba8419e48cccf64f37f1983ac4727cfb38b57703ffc9': read_rewardCall, # Reward
+    '0x8b87351a208c06e3ceee59d80725fd77a23b4129e1b51ca231fc89b40712649c': read_ticketRedemption, # WinningTicketRedeemed
+}
+
+# Event topic -> handler undoing the state changes of an event which was removed in a reorg
+rollback_handlers = {
+    '0x619caafabdd75649b302ba8419e48cccf64f37f1983ac4727cfb38b57703ffc9': undo_rewardCall, # Reward
+    '0x8b87351a208c06e3ceee59d80725fd77a23b4129e1b51ca231fc89b40712649c': undo_ticketRedemption, # WinningTicketRedeemed
+}
+
+def get_logs(fromBlock, toBlock):
+    """Fetches the logs of all watched events between fromBlock and toBlock with a single eth_getLogs call.
     
-    If an event exists, get the blocknumber of this tx and the round number
+    Returns them sorted by block number and log index.
     """
-    round_filter = w3.eth.filter({
+    logs = w3logs.eth.getLogs({
     "fromBlock": fromBlock,
     "toBlock": toBlock,
-    "address": ROUND_MANAGER_PROXY,
-    "topics": ['0x22f2fc17c5daf07db2379b3a03a8ef20a183f761097a58fce219c8a14619e786'],
+    "address": sorted({contract for contract, handler in event_handlers.values()}),
+    "topics": [list(event_handlers.keys())],
     })
-    result = round_filter.get_all_entries()
-    if result:
-        return result[0]["blockNumber"], w3.toInt(result[0]["topics"][1])
-    else:
-        return None, None
+    return sorted(logs, key=lambda event: (event["blockNumber"], event["logIndex"]))
+
+def key_logs(logs):
+    """Returns the logs, which are sorted by block number and log index, with their "logKey", see store.log_key().
+
+    Identical logs of a transaction are told apart by their position among each other, a transaction's logs are
+    always in the same block and so in the same chunk or streamed batch. Removed logs are counted separately.
+    """
+    positions = {}
+    keyed = []
+    for event in logs:
+        topics = [t.hex() for t in event["topics"]]
+        content = (event["transactionHash"].hex(), json.dumps([topics, event["data"]]), bool(event.get("removed")))
+        position = positions[content] = positions.get(content, -1) + 1
+        keyed.append(AttributeDict(dict(event, logKey=log_key(topics, event["data"], position))))
+    return keyed
+
+def event_key(event):
+    """(transaction hash, log key) of the event, see key_logs()
+    """
+    return event["transactionHash"].hex(), event["logKey"]
+
+def process_logs(logs):
+    """Routes every log to the handler of its event topic.
+    
+    Every log is handled once, keyed by transaction hash and log key, so overlapping block ranges can be scanned again
+    and a transaction which moved to another block in a reorg is not handled twice.
+    Logs the stream flags as removed are rolled back, unless their transaction is included again in the same window.
+    """
+    included = {event_key(event) for event in logs if not event.get("removed")}
+    for event in logs:
+        contract, handler = event_handlers.get(event["topics"][0].hex(), (None, None))
+        # Only accept the event from the contract that is supposed to emit it
+        if not handler or event["address"] != contract:
+            continue
+        if event.get("removed"):
+            if event_key(event) not in included:
+                rollback_log(event)
+        elif store.add_processed_log(*event_key(event), event["logIndex"], event["blockNumber"], event["blockHash"].hex(),
+                [t.hex() for t in event["topics"]], event["data"]):
+            handler(event)
+            EVENTS.inc(handler=handler.__name__)
+
+def prefetch_reads(logs):
+    """Makes the contract reads the handlers of the new logs need, before the store transaction takes the write lock.
+
+    Reads of the same window go into one multicall. The round change also reads the pool snapshot here.
+    """
+    readCache.clear()
+    poolSnapshots.clear()
+    calls = []
+    for event in logs:
+        read = read_handlers.get(event["topics"][0].hex())
+        if read and not event.get("removed") and not store.is_processed_log(*event_key(event)):
+            calls.extend(read(event))
+    readCache.prefetch(multicall, calls)
+
+def event_orchestrator(event):
+    """Returns the orchestrator address of the event, None for events concerning all orchestrators
+    """
+    return topics_orchestrator([t.hex() for t in event["topics"]])
+
+def topics_orchestrator(topics):
+    index = event_orchestrator_topic.get(topics[0])
+    return w3.toChecksumAddress("0x" + topics[index][26:]) if index else None
+
+def round_changes(logs):
+    """Returns the round numbers of the NewRound events in logs
+    """
+    rounds = []
+    for event in logs:
+        contract, handler = event_handlers.get(event["topics"][0].hex(), (None, None))
+        if handler == check_round_change and event["address"] == contract and not event.get("removed"):
+            rounds.append(w3.toInt(event["topics"][1]))
+    return rounds
+
+def rollback_log(event):
+    """Undoes a processed log which is no longer part of the chain
+    """
+    if store.remove_processed_log(*event_key(event)):
+        handler = rollback_handlers.get(event["topics"][0].hex())
+        if handler:
+            handler(event)
+        REORGED_EVENTS.inc()
+        print("Rolled back event {}:{} of block {} (reorg)".format(event["transactionHash"].hex(), event["logIndex"], event["blockNumber"]))
+
+def rollback_reorged_logs(logs, fromBlock, toBlock):
+    """Rolls back the processed logs between fromBlock and toBlock which are not in logs (the current logs of that range)
+    """
+    keys = {event_key(event) for event in logs}
+    for txHash, logKey, logIndex, block, blockHash, topics, data in store.get_processed_logs(fromBlock, toBlock):
+        if (txHash, logKey) not in keys:
+            rollback_log(AttributeDict({"transactionHash": HexBytes(txHash), "logKey": logKey, "logIndex": logIndex, "blockNumber": block,
+                "blockHash": HexBytes(blockHash), "topics": [HexBytes(t) for t in topics], "data": data}))
+
+def scan_range(fromBlock, toBlock):
+    """Processes the logs between fromBlock and toBlock (inclusive) in chunks.
+    
+    Each chunk is processed in one store transaction together with its checkpoint and the transcoder flags,
+    so after a restart or an error only the unfinished chunk is processed again.
+    """
+    for start, end, logs in iter_chunks(get_logs, fromBlock, toBlock, chunkSizer):
+        commit_logs(logs, end, start)
+        BLOCK_LAG.set(toBlock - end)
+        if end < toBlock:
+            print("Backfilled until: " + str(arbitrumBlockOld))
+
+def commit_logs(logs, toBlock, fromBlock=None):
+    """Processes the logs of all blocks up to toBlock in one store transaction together with the checkpoint and the transcoder flags.
+    
+    If logs are all logs from fromBlock to toBlock, processed logs of that range which are missing were reorganized and are rolled back.
+    """
+    global arbitrumBlockOld, roundNrOld
+    # Rescanned blocks never move the checkpoint back, the reorg check still ends at toBlock (later blocks are not in logs)
+    checkpoint = max(arbitrumBlockOld, toBlock)
+    if shardPool:
+        # Every shard commits the events of its orchestrators, the checkpoint only moves once all of them did
+        parts = shardPool.partition([dict(event) for event in logs], event_orchestrator)
+        shardPool.run([("logs", part, toBlock, fromBlock) for part in parts])
+        # The shards keep their own round, the one in watcher.db is read by telegram-subscriptions.py
+        roundNr = max(round_changes(logs) + [roundNrOld])
+        with store.transaction():
+            store.remove_transcoder_flags(droppedTranscoders)
+            store.set_checkpoint("arbitrumBlock", checkpoint)
+            store.set_checkpoint("roundNr", roundNr)
+        droppedTranscoders.clear()
+        arbitrumBlockOld, roundNrOld = checkpoint, roundNr
+        return
+    logs = key_logs(logs)
+    # No RPC requests while the write lock on the shared database is held
+    prefetch_reads(logs)
+    # The reorg check reads before the first write
+    with store.transaction(immediate=True):
+        if fromBlock is not None:
+            rollback_reorged_logs(logs, fromBlock, toBlock)
+        process_logs(logs)
+        # Only the flags which changed in the window
+        changed = [t for t in transcoder.values() if (t.rewardCalled, t.isActive) != t.storedFlags]
+        store.set_transcoder_flags(changed)
+        store.remove_transcoder_flags(droppedTranscoders)
+        store.set_checkpoint("arbitrumBlock", checkpoint)
+        store.prune_processed_logs(checkpoint - processed_logs_kept)
+        notifier.flush_digests()
+    for t in changed:
+        t.storedFlags = (t.rewardCalled, t.isActive)
+    droppedTranscoders.clear()
+    readCache.clear()
+    arbitrumBlockOld = checkpoint
+    # Only once the processed blocks are committed
+    notifier.release()
+
+def scan_new_blocks(head):
+    """Scans the blocks since the checkpoint which have enough confirmations, together with the last reorg_depth processed blocks
+    """
+    scan_range(max(arbitrumBlockOld + 1 - reorg_depth, 0), head - confirmations)
 
 ###
 # Loop
@@ -237,66 +581,314 @@ def check_round_change(fromBlock, toBlock):
 
 
 transcoder = {}
+# Addresses removed from the transcoder dict since the last commit, see drop_transcoder()
+droppedTranscoders = set()
+# Subscription version the transcoder dict is based on, -1 forces a full load
+subscriptionsVersion = -1
+# Latest snapshot of the transcoder pool, see get_active_transcoders()
+activeTranscoders = {}
+# Snapshots read by prefetch_reads(), block -> snapshot
+poolSnapshots = {}
+# Schedule of the current round and its pending reward deadlines (mainnet block -> share of the round)
+roundSchedule = None
+deadlineWheel = TimerWheel()
+# Last processed round, arbitrum block and mainnet block (used for the reward call status warnings)
+roundNrOld = 0
+arbitrumBlockOld = 0
+mainnetBlockOld = 0
 # Just for debugging: Avoid sending the same telegram exception message every polling interval
 latestError = 0 
 
-def main():
+def load_state():
+    """Loads the checkpoints and transcoder flags from the store.
+    
+    Also used after a failed cycle, since the store rolled back the unfinished chunk.
+    """
+    global roundNrOld, arbitrumBlockOld, mainnetBlockOld, roundSchedule
+    arbitrumBlockOld = store.get_checkpoint("arbitrumBlock")
+    if arbitrumBlockOld is None:
+        raise SystemExit("No checkpoints in {} - run store.py once to migrate the record files".format(store.path))
+    mainnetBlockOld = store.get_checkpoint("mainnetBlock")
+    roundNrOld = store.get_checkpoint("roundNr")
+    # Reloaded with the next deadline check, the deadlines since the mainnet checkpoint are due again
+    roundSchedule = None
+    for t in transcoder.values():
+        load_transcoder_flags(t)
+
+def load_round_schedule():
+    """Reads start and length of the current round from the RoundManager (one multicall per round)
+    and schedules the reward deadlines after the last checked mainnet block.
+    """
+    global roundSchedule
+    calls = round_schedule_calls()
+    readCache.prefetch(multicall, calls)
+    roundNr, start, length = [readCache.call(fn) for fn in calls]
+    roundSchedule = RoundSchedule(roundNr, start, length, reward_deadlines)
+    deadlineWheel.clear()
+    for block, share in roundSchedule.deadlines:
+        if block > max(mainnetBlockOld, start):
+            deadlineWheel.add(block, share)
+    return roundSchedule
+
+def round_schedule_calls():
+    return [round_manager_proxy.functions.currentRound(), round_manager_proxy.functions.currentRoundStartBlock(), round_manager_proxy.functions.roundLength()]
+
+def check_deadlines(mainnetBlock=None):
+    """Sends the reward call status warnings if a reward deadline passed since the last check.
+    
+    Returns the seconds until the next deadline (or the end of the round) is expected.
+    """
+    global mainnetBlockOld
+    mainnetBlock = mainnetBlock or w3m.eth.blockNumber
+    if roundSchedule is None or mainnetBlock >= roundSchedule.end:
+        # Not part of a processing window, the cached reads may be from an earlier round
+        readCache.clear()
+        load_round_schedule()
+    if deadlineWheel.advance(mainnetBlock):
+        if shardPool:
+            shardPool.run([("deadlines", mainnetBlock)] * shardPool.count)
+        with store.transaction():
+            if not shardPool:
+                check_rewardCall_status(mainnetBlock)
+                notifier.flush_digests()
+            store.set_checkpoint("mainnetBlock", mainnetBlock)
+        mainnetBlockOld = mainnetBlock
+        notifier.release()
+    nextBlock = deadlineWheel.next_block() or roundSchedule.end
+    if nextBlock <= mainnetBlock:
+        # The round is over, but the next one is not initialized yet
+        return poll_interval
+    return (nextBlock - mainnetBlock) * mainnet_block_time
+
+cycleTimings = {}
+
+def timed(phase, function, *args):
+    """Calls the function and records its duration for the phase
+    """
+    start = time.time()
+    try:
+        return function(*args)
+    finally:
+        duration = time.time() - start
+        PHASE_TIME.observe(duration, phase=phase)
+        cycleTimings[phase] = cycleTimings.get(phase, 0) + duration
+
+def print_timings():
+    if profile and cycleTimings:
+        print("Timings: " + ", ".join("{} {:.3f}s".format(phase, duration) for phase, duration in cycleTimings.items()))
+    cycleTimings.clear()
+
+def handle_error(ex):
     global latestError
-    # Mainnet
-    with open('mainnet_block_records.txt', 'r') as fh:
-        mainnetBlockOld = int(fh.readlines()[-1])
-    # Arbitrum
-    with open('arbitrum_block_records.txt', 'r') as fh:
-        arbitrumBlockOld = int(fh.readlines()[-1])
-    # Rounds
-    with open('roundNr_records.txt', 'r') as fh:
-        roundNrOld = int(fh.readlines()[-1])
+    print(ex)
+    # The unfinished blocks are processed again
+    notifier.discard_digests()
+    load_state()
+    # Only send telegram message if its a different error
+    if str(ex) != latestError:
+        send_message(ex, MY_TELEGRAM_ID)
+        latestError = str(ex)
+
+def shard_store_path(index, count):
+    return sharedStore.path.replace(".db", ".shard{}of{}.db".format(index + 1, count))
+
+def move_orchestrator_state(count):
+    """Moves the transcoder flags, ticket sums and processed logs to the databases of count shards (watcher.db for 0)
+    if the number of shards changed since the last start.
+
+    The state of an orchestrator goes to the shard the hash ring assigns it to, processed events concerning all orchestrators
+    to every shard. The checkpoints are taken from watcher.db, which the coordinator keeps up to date.
+    Notifications which were not delivered yet go to the outbox of the first shard.
+    """
+    previous = sharedStore.get_checkpoint("shards", 0)
+    if previous == count:
+        return
+    sources = [Store(shard_store_path(i, previous)) for i in range(previous)] or [sharedStore]
+    targets = [Store(shard_store_path(i, count)) for i in range(count)] or [sharedStore]
+    ring = HashRing(len(targets))
+    parts = [([], [], {}) for target in targets]
+    for source in sources:
+        flags, tickets, logs = source.get_orchestrator_state()
+        for row in flags:
+            parts[ring.shard(row[0])][0].append(row)
+        for row in tickets:
+            parts[ring.shard(row[0])][1].append(row)
+        for row in logs:
+            address = topics_orchestrator(row[5])
+            for index in ([ring.shard(address)] if address else range(len(targets))):
+                parts[index][2][row[:2]] = row
+    checkpoints = {name: sharedStore.get_checkpoint(name) for name in ("arbitrumBlock", "mainnetBlock", "roundNr")}
+    outbox = {source: source.get_outbox() for source in sources}
+    for target, (flags, tickets, logs) in zip(targets, parts):
+        target.replace_orchestrator_state(flags, tickets, list(logs.values()), checkpoints)
+    targets[0].add_outbox([(text, chat_id) for rows in outbox.values() for id, text, chat_id in rows])
+    for source, rows in outbox.items():
+        for id, text, chat_id in rows:
+            source.remove_outbox(id)
+    sharedStore.set_checkpoint("shards", count)
+    print("Moved the orchestrator state from {} to {} shards".format(previous, count))
+
+def run_shard(index, count, inbox, outbox):
+    """Entry point of a shard process (--shards): handles the events of the orchestrators the hash ring assigns to it.
+    
+    The shard keeps its checkpoints, processed logs, ticket accumulators and transcoder flags in its own database
+    (prepared by move_orchestrator_state()), so the shards never wait on each other.
+    """
+    global store, shardIndex, shardRing
+    shardIndex, shardRing = index, HashRing(count)
+    set_budget_share(rpc_budget_share / (count + 1))
+    store = Store(shard_store_path(index, count))
+    notifier.outbox = store
+    notifier.start()
+    for pool in providerPools:
+        pool.start()
+    start_server(shard_metrics_port + index)
+    load_state()
+    update_transcoder_instances()
     while True:
+        seq, kind, *args = inbox.get()
         try:
-            arbitrumBlock = w3.eth.blockNumber
-            mainnetBlock = w3m.eth.blockNumber
-            update_transcoder_instances()
-            roundStartBlock, roundNr = check_round_change(arbitrumBlockOld, arbitrumBlock)
-            if roundStartBlock and roundNr > roundNrOld:
-                # In this case, process the previous round from blockOld to the first block of the new round
-                check_rewardCut_changes(arbitrumBlockOld, roundStartBlock)
-                check_rewardCall(arbitrumBlockOld, roundStartBlock)
-                check_ticketRedemption(arbitrumBlockOld, roundStartBlock)
-                # Set the blockOld to last processed blocknumber
-                mainnetBlockOld = round_manager_proxy.functions.currentRoundStartBlock().call()
-                arbitrumBlockOld = roundStartBlock
-                roundNrOld = roundNr # otherwise we process the same round again and again due to the above assignment
-                # Write to processed blocks to both files - in case we need to restart the script
-                with open('mainnet_block_records.txt', 'a') as fh:
-                    fh.write(str(mainnetBlockOld) + "\n")
-                with open('arbitrum_block_records.txt', 'a') as fh:
-                    fh.write(str(arbitrumBlockOld) + "\n")
-                with open('roundNr_records.txt', 'a') as fh:
-                    fh.write(str(roundNrOld) + "\n")
-                process_round()
-                print("processed round at block {}".format(str(arbitrumBlockOld)))
-            # Run checks once there are at least 500 new blocks since last check
-            if mainnetBlock > mainnetBlockOld + 500:
-                check_rewardCut_changes(arbitrumBlockOld, arbitrumBlock)
-                check_rewardCall(arbitrumBlockOld, arbitrumBlock)
-                check_rewardCall_status(mainnetBlock) #we only use the block for the notification, no query necessary
-                check_ticketRedemption(arbitrumBlockOld, arbitrumBlock)
-                # Set the blockOld to last processed blocknumber
-                mainnetBlockOld = mainnetBlock
-                arbitrumBlockOld = arbitrumBlock
-                # Write to processed blocks file
-                with open('mainnet_block_records.txt', 'a') as fh:
-                    fh.write(str(mainnetBlockOld) + "\n")
-                with open('arbitrum_block_records.txt', 'a') as fh:
-                    fh.write(str(arbitrumBlockOld) + "\n")
-                print("Processed until: " + str(arbitrumBlockOld))
+            if kind == "logs":
+                update_transcoder_instances()
+                commit_logs(*args)
+            elif kind == "deadlines":
+                check_deadlines(*args)
+            outbox.put(("done", index, seq))
         except Exception as ex:
             print(ex)
-            # Only send telegram message if its a different error
-            if str(ex) != latestError:
-                send_message(ex, MY_TELEGRAM_ID)
-                latestError = str(ex)
-        time.sleep(poll_interval)
+            notifier.discard_digests()
+            load_state()
+            outbox.put(("error", index, seq, str(ex)))
+
+def main():
+    """Polling mode: scans the new blocks every poll_interval seconds, or earlier at the next reward deadline
+    """
+    # Before the outbox is loaded, it may move to the shards
+    move_orchestrator_state(shardPool.count if shardPool else 0)
+    notifier.start()
+    for pool in providerPools:
+        pool.start()
+    start_server(metrics_port)
+    load_state()
+    while True:
+        try:
+            arbitrumBlock = w3.eth.blockNumber
+            timed("subscriptions", update_transcoder_instances)
+            # One log scan per cycle (split into chunks after a downtime), a round change is processed in order with the other events
+            timed("scan", scan_new_blocks, arbitrumBlock)
+            # After the scan, so reward calls up to now are known
+            untilDeadline = timed("deadlines", check_deadlines)
+            print("Processed until: {} (read cache hits: {}, misses: {})".format(arbitrumBlockOld, readCache.hits, readCache.misses))
+        except Exception as ex:
+            handle_error(ex)
+            untilDeadline = poll_interval
+        print_timings()
+        time.sleep(min(poll_interval, untilDeadline))
+
+class StreamState:
+    """Buffer and scan state of the streaming mode, see main_stream()
+    """
+
+    def __init__(self):
+        # Streamed logs of blocks which are not committed yet
+        self.buffered = []
+        # False until the blocks since the checkpoint were scanned after (re)connecting, an error or a late log
+        self.gapFilled = False
+        self.lastFlush = self.lastScan = 0
+
+    def step(self, events):
+        """Handles the next event of the stream's queue, a "poll" with the current block number if none arrived within poll_interval.
+        
+        Returns the head if blocks were processed, None otherwise.
+        """
+        try:
+            kind, value = events.get(timeout=poll_interval)
+        except queue.Empty:
+            # Stream is stuck -> fall back to polling
+            kind, value = "poll", w3.eth.blockNumber
+        if kind == "log":
+            if value["removed"]:
+                pending = [e for e in self.buffered if not e["removed"] and (e["transactionHash"], e["logIndex"]) == (value["transactionHash"], value["logIndex"])]
+                if pending:
+                    self.buffered.remove(pending[0])
+                    return None
+            elif self.gapFilled and value["blockNumber"] <= arbitrumBlockOld:
+                # Its block was already committed, scanned again with the next head
+                LATE_LOGS.inc()
+                self.gapFilled = False
+                return None
+            self.buffered.append(value)
+            return None
+        if kind in ("connected", "disconnected"):
+            print("Stream {} {}".format(kind, value or ""))
+            self.gapFilled = False
+            return None
+        head = value
+        timed("subscriptions", update_transcoder_instances)
+        if not self.gapFilled or kind == "poll" or time.time() > self.lastScan + poll_interval:
+            timed("scan", scan_new_blocks, head)
+            self.gapFilled = True
+            self.lastScan = time.time()
+            print("Processed until: {}".format(arbitrumBlockOld))
+        else:
+            # Everything before the head is complete, logs of already scanned blocks were handled by the gap fill
+            ready = [e for e in self.buffered if e["removed"] or arbitrumBlockOld < e["blockNumber"] < head - confirmations]
+            if ready or time.time() > self.lastFlush + stream_flush_interval:
+                timed("commit", commit_logs, sorted(ready, key=lambda event: (event["blockNumber"], event["logIndex"])), head - 1 - confirmations)
+                self.lastFlush = time.time()
+        BLOCK_LAG.set(head - arbitrumBlockOld)
+        self.buffered = [e for e in self.buffered if e["blockNumber"] > arbitrumBlockOld and not e["removed"]]
+        return head
+
+def main_stream():
+    """Streaming mode: handles the logs pushed by the websocket subscription within seconds.
+    
+    Logs are buffered until a newer head arrives, then all blocks before that head (minus the confirmations) are committed.
+    Logs removed in a reorg are dropped from the buffer, or rolled back if they were already committed.
+    After (re)connecting, after an error, after a log arrived late (the logs and newHeads subscriptions are not ordered)
+    and at least every poll_interval seconds, the blocks since the checkpoint and the last reorg_depth blocks are scanned
+    with eth_getLogs instead, so nothing is missed while the stream is down or behind.
+    """
+    # Before the outbox is loaded, it may move to the shards
+    move_orchestrator_state(shardPool.count if shardPool else 0)
+    notifier.start()
+    for pool in providerPools:
+        pool.start()
+    start_server(metrics_port)
+    load_state()
+    stream = LogStream(stream_urls, sorted({contract for contract, handler in event_handlers.values()}), list(event_handlers.keys())).start()
+    state = StreamState()
+    lastTimings = nextDeadlineCheck = 0
+    while True:
+        try:
+            if state.step(stream.events) is None:
+                continue
+            if time.time() >= nextDeadlineCheck:
+                nextDeadlineCheck = time.time() + timed("deadlines", check_deadlines)
+            if time.time() > lastTimings + poll_interval:
+                print_timings()
+                lastTimings = time.time()
+        except Exception as ex:
+            handle_error(ex)
+            state.gapFilled = False
+            time.sleep(stream.reconnectDelay)
 
 if __name__ == '__main__':
-    main()
+    if "--record" in sys.argv:
+        # Record all RPC responses to the given file, to replay them with bench.py
+        from replay import record
+        atexit.register(record(sys.modules[__name__], sys.argv[sys.argv.index("--record") + 1]).close)
+    if "--shards" in sys.argv:
+        # The coordinator (this process) only scans the logs, the shard processes handle the events.
+        # They are started with the first events, once main() moved their state
+        shardPool = ShardPool(int(sys.argv[sys.argv.index("--shards") + 1]), run_shard)
+        set_budget_share(rpc_budget_share / (shardPool.count + 1))
+    else:
+        set_budget_share(rpc_budget_share)
+    if "--poll" in sys.argv:
+        main()
+    elif not stream_urls:
+        print("No websocket endpoint in ARBITRUM_ENDPOINTS, falling back to polling mode")
+        main()
+    else:
+        main_stream()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import gzip
+import importlib.util
+import json
+import os
+import threading
+from collections import Counter
+from web3 import Web3
+from web3.providers.base import BaseProvider
+from cache import ReadCache
+from notifier import split_digest
+from multicall import get_multicall
+from store import Store
+
+###
+# Recording & replaying RPC responses
+###
+
+def open_recording(path, mode):
+    return gzip.open(path, mode + "t") if path.endswith(".gz") else open(path, mode)
+
+def request_key(method, params):
+    return json.dumps([method, params], sort_keys=True)
+
+class Recorder:
+    """Appends every request/response pair to a JSON lines file (gzip compressed if the path ends with .gz)
+    """
+
+    def __init__(self, path):
+        self.file = open_recording(path, "a")
+        self.lock = threading.Lock()
+
+    def write(self, method, params, response):
+        with self.lock:
+            self.file.write(json.dumps({"m": method, "p": params, "r": response}, separators=(",", ":")) + "\n")
+
+    def close(self):
+        self.file.close()
+
+class RecordingProvider(BaseProvider):
+    """Passes the requests to the wrapped provider and records them
+    """
+
+    def __init__(self, provider, recorder):
+        self.provider = provider
+        self.recorder = recorder
+
+    def make_request(self, method, params):
+        response = self.provider.make_request(method, params)
+        self.recorder.write(method, params, response)
+        return response
+
+    def isConnected(self):
+        return self.provider.isConnected()
+
+class CountingProvider(BaseProvider):
+    """Base for the offline providers: counts the requests per method (eth_call per contract function)
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def isConnected(self):
+        return True
+
+class ReplayProvider(CountingProvider):
+    """Answers the requests from a recording made by RecordingProvider.
+
+    Identical requests are answered in the recorded order, the last response is repeated afterwards.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.responses = {}
+        with open_recording(path, "r") as f:
+            for line in f:
+                entry = json.loads(line)
+                self.responses.setdefault(request_key(entry["m"], entry["p"]), []).append(entry["r"])
+
+    def make_request(self, method, params):
+        self.count(method)
+        responses = self.responses.get(request_key(method, params))
+        if not responses:
+            return {"jsonrpc": "2.0", "id": 0, "error": {"code": -32000, "message": "not recorded: {} {}".format(method, params)}}
+        with self.lock:
+            return responses.pop(0) if len(responses) > 1 else responses[0]
+
+###
+# Loading the watcher with offline providers
+###
+
+class CountingNotifier:
+    """Stands in for the Notifier, only counts the messages
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.chats = set()
+        self.digests = {}
+        self.urgent = []
+
+    def start(self):
+        return self
+
+    def send(self, text, chat_id):
+        self.sent += 1
+        self.chats.add(chat_id)
+
+    def add_digest(self, text, chat_id, urgent=False):
+        if urgent:
+            self.urgent.append((text, chat_id))
+        else:
+            self.digests.setdefault(chat_id, []).append(text)
+
+    def flush_digests(self):
+        for text, chat_id in self.urgent:
+            self.send(text, chat_id)
+        for chat_id, texts in self.digests.items():
+            for message in split_digest(texts):
+                self.send(message, chat_id)
+        self.digests = {}
+        self.urgent = []
+
+    def release(self):
+        pass
+
+    def discard_digests(self):
+        self.digests = {}
+        self.urgent = []
+
+    def qsize(self):
+        return 0
+
+def load_watcher(provider, store=None, notifier=None):
+    """Imports orchestrator-watcher.py and points all its connections to the given provider.
+
+    Uses an in-memory store and a CountingNotifier unless given, so nothing is sent or persisted.
+    The stores the module opens on import are in-memory as well, so watcher.db is never touched.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "orchestrator-watcher.py")
+    spec = importlib.util.spec_from_file_location("orchestrator_watcher", path)
+    watcher = importlib.util.module_from_spec(spec)
+    previous = os.environ.get("WATCHER_DB")
+    os.environ["WATCHER_DB"] = ":memory:"
+    try:
+        spec.loader.exec_module(watcher)
+    finally:
+        if previous is None:
+            del os.environ["WATCHER_DB"]
+        else:
+            os.environ["WATCHER_DB"] = previous
+    w3 = Web3(provider)
+    watcher.w3 = watcher.w3m = watcher.w3logs = w3
+    watcher.bonding_manager_proxy = w3.eth.contract(address=watcher.bonding_manager_proxy.address, abi=watcher.bonding_manager_proxy.abi)
+    watcher.round_manager_proxy = w3.eth.contract(address=watcher.round_manager_proxy.address, abi=watcher.round_manager_proxy.abi)
+    watcher.multicall = get_multicall(w3)
+    watcher.store = watcher.sharedStore = store or Store(":memory:")
+    watcher.providerPools = []
+    watcher.notifier = notifier or CountingNotifier()
+    watcher.readCache = ReadCache()
+    return watcher
+
+def record(watcher, path):
+    """Wraps the connections of the running watcher, so all its RPC responses are recorded to path
+    """
+    recorder = Recorder(path)
+    for w3 in {watcher.w3, watcher.w3m, watcher.w3logs}:
+        w3.provider = RecordingProvider(w3.provider, recorder)
+    return recorder
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+from web3 import Web3
+from web3.providers.base import BaseProvider
+from notifier import TokenBucket
+from metrics import Counter, Gauge
+
+# Requests which are also sent to a second endpoint if the first one is slow
+HEDGED_METHODS = ("eth_call", "eth_getLogs")
+# Number of recent latencies per method the hedge delay is based on
+LATENCY_SAMPLES = 200
+# Requests whose answer never changes, only sent once (the web3 validation middleware asks for the chain id before every eth_call)
+CACHED_METHODS = ("eth_chainId",)
+
+ENDPOINT_HEALTHY = Gauge("rpc_endpoint_healthy", "1 if the endpoint passed the last health check")
+ENDPOINT_LATENCY = Gauge("rpc_endpoint_latency_seconds", "Moving average of the request latency per endpoint")
+HEDGED_REQUESTS = Counter("rpc_hedged_requests_total", "Requests also sent to a second endpoint because the first one was slow")
+FAILOVERS = Counter("rpc_failovers_total", "Requests which failed on the endpoint and were retried on another one")
+
+# Request budget per endpoint url as (rate, bucket), shared by all pools of the process: the plan limits the API key, not the connection
+budgets = {}
+budgetLock = threading.Lock()
+# Share of the budgets this process may use, see set_budget_share()
+budgetShare = 1
+
+def shared_bucket(url, rate):
+    """Returns the token bucket of the endpoint, the same one for every pool of the process
+    """
+    with budgetLock:
+        if url not in budgets:
+            budgets[url] = (rate, TokenBucket(rate * budgetShare, max(1, rate * budgetShare)))
+        return budgets[url][1]
+
+def set_budget_share(share):
+    """Limits this process to the given share of every endpoint budget, if other processes use the same endpoints
+    """
+    global budgetShare
+    with budgetLock:
+        budgetShare = share
+        for rate, bucket in budgets.values():
+            bucket.rate = rate * share
+            bucket.capacity = max(1, rate * share)
+            bucket.tokens = min(bucket.tokens, bucket.capacity)
+
+def make_provider(url, timeout):
+    if url.startswith("ws"):
+        return Web3.WebsocketProvider(url, websocket_timeout=timeout)
+    return Web3.HTTPProvider(url, request_kwargs={"timeout": timeout})
+
+class Endpoint:
+    """A single RPC endpoint with its request budget (requests per second, None for unlimited), latency and health.
+
+    The budget is shared with the other endpoints of the process with the same url.
+    """
+
+    def __init__(self, url, rate=None, timeout=30):
+        self.url = url
+        # The path usually contains the API key
+        self.name = urlparse(url).netloc
+        self.provider = make_provider(url, timeout)
+        self.bucket = shared_bucket(url, rate) if rate else None
+        # The websocket provider can't handle concurrent requests
+        self.lock = threading.Lock() if url.startswith("ws") else nullcontext()
+        self.inFlight = 0
+        self.inFlightLock = threading.Lock()
+        self.latency = None
+        self.healthy = True
+        self.block = None
+
+    def expected_time(self):
+        """Expected seconds until a new request is answered, unmeasured endpoints first
+        """
+        return (self.latency or 0) * (self.inFlight + 1)
+
+    def request(self, method, params):
+        start = time.time()
+        with self.inFlightLock:
+            self.inFlight += 1
+        try:
+            with self.lock:
+                response = self.provider.make_request(method, params)
+        finally:
+            with self.inFlightLock:
+                self.inFlight -= 1
+        duration = time.time() - start
+        self.latency = duration if self.latency is None else 0.8 * self.latency + 0.2 * duration
+        ENDPOINT_LATENCY.set(self.latency, endpoint=self.name)
+        return response
+
+    def set_healthy(self, healthy):
+        self.healthy = healthy
+        ENDPOINT_HEALTHY.set(int(healthy), endpoint=self.name)
+
+class ProviderPool(BaseProvider):
+    """web3 provider spreading the requests over multiple endpoints of the same chain.
+
+    endpoints is a list of (url, rate) with the request budget of the endpoint in requests per second (None for unlimited),
+    shared by all pools of the process which use the url.
+    Every request goes to the healthy endpoint with the lowest expected time (average latency, times the requests it is
+    still busy with) which has budget left, and is retried on the next one if it fails.
+    eth_call and eth_getLogs are also sent to the next endpoint if the first one didn't answer within the hedgePercentile
+    of the recent latencies of the method (at least hedgeAfter seconds), the first answer wins. So only the slowest
+    requests are sent twice, also for eth_getLogs ranges which are sized to take seconds.
+    After start(), a background thread checks all endpoints every healthInterval seconds: endpoints which fail or lag
+    more than maxLag blocks behind the others are skipped until they recover.
+    Responses with a JSON-RPC error (reverted calls, too large log queries) are returned as they are.
+    """
+
+    def __init__(self, endpoints, hedgeAfter=1.0, hedgePercentile=0.95, healthInterval=30, maxLag=20, timeout=30):
+        self.endpoints = [Endpoint(url, rate, timeout) for url, rate in endpoints]
+        self.hedgeAfter = hedgeAfter
+        self.hedgePercentile = hedgePercentile
+        self.latencies = {} # method -> recent latencies
+        self.healthInterval = healthInterval
+        self.maxLag = maxLag
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=2 * len(self.endpoints) + 2)
+        self.cache = {}
+        self.thread = None
+
+    def start(self):
+        if not self.thread:
+            self.check_health()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.healthInterval)
+            self.check_health()
+
+    def check_health(self):
+        """Asks all endpoints for their latest block, endpoints which fail or lag behind are marked unhealthy
+        """
+        def block_number(endpoint):
+            try:
+                return int(endpoint.request("eth_blockNumber", [])["result"], 16)
+            except Exception:
+                return None
+        blocks = list(self.executor.map(block_number, self.endpoints))
+        best = max([b for b in blocks if b is not None], default=None)
+        for endpoint, block in zip(self.endpoints, blocks):
+            endpoint.block = block
+            endpoint.set_healthy(block is not None and block >= best - self.maxLag)
+
+    def _choose(self, exclude=()):
+        """Returns the fastest healthy endpoint (any endpoint if none is healthy) which is not in exclude, waits for its budget.
+
+        Returns None if all endpoints are excluded.
+        """
+        while True:
+            with self.lock, budgetLock:
+                candidates = [e for e in self.endpoints if e not in exclude]
+                if not candidates:
+                    return None
+                candidates = [e for e in candidates if e.healthy] or candidates
+                candidates.sort(key=lambda e: e.expected_time())
+                waits = [e.bucket.wait_time() if e.bucket else 0 for e in candidates]
+                for endpoint, waitTime in zip(candidates, waits):
+                    if waitTime == 0:
+                        if endpoint.bucket:
+                            endpoint.bucket.take()
+                        return endpoint
+            time.sleep(min(waits))
+
+    def hedge_delay(self, method):
+        """Seconds after which the request is also sent to a second endpoint
+        """
+        with self.lock:
+            samples = sorted(self.latencies.get(method, ()))
+        if not samples:
+            return self.hedgeAfter
+        return max(self.hedgeAfter, samples[min(len(samples) - 1, int(len(samples) * self.hedgePercentile))])
+
+    def _call(self, endpoint, method, params):
+        start = time.time()
+        response = endpoint.request(method, params)
+        with self.lock:
+            self.latencies.setdefault(method, deque(maxlen=LATENCY_SAMPLES)).append(time.time() - start)
+        return response
+
+    def _failed(self, endpoint):
+        FAILOVERS.inc(endpoint=endpoint.name)
+        endpoint.set_healthy(False)
+
+    def make_request(self, method, params):
+        if method in self.cache:
+            return self.cache[method]
+        if method in HEDGED_METHODS and len(self.endpoints) > 1:
+            response = self._hedged_request(method, params)
+        else:
+            response = self._request(method, params)
+        if method in CACHED_METHODS and "result" in response:
+            self.cache[method] = response
+        return response
+
+    def _request(self, method, params):
+        tried = []
+        error = ConnectionError("No RPC endpoint available")
+        while True:
+            endpoint = self._choose(tried)
+            if endpoint is None:
+                raise error
+            try:
+                return self._call(endpoint, method, params)
+            except Exception as ex:
+                self._failed(endpoint)
+                tried.append(endpoint)
+                error = ex
+
+    def _hedged_request(self, method, params):
+        endpoint = self._choose()
+        tried = [endpoint]
+        pending = {self.executor.submit(self._call, endpoint, method, params): endpoint}
+        hedged = False
+        hedgeDelay = self.hedge_delay(method)
+        error = None
+        while pending:
+            done, _ = wait(pending, timeout=None if hedged else hedgeDelay, return_when=FIRST_COMPLETED)
+            if not done:
+                # Too slow, ask the next endpoint as well
+                hedged = True
+                endpoint = self._choose(tried)
+                if endpoint:
+                    HEDGED_REQUESTS.inc()
+                    tried.append(endpoint)
+                    pending[self.executor.submit(self._call, endpoint, method, params)] = endpoint
+                continue
+            for future in done:
+                endpoint = pending.pop(future)
+                try:
+                    return future.result()
+                except Exception as ex:
+                    self._failed(endpoint)
+                    error = ex
+            if not pending:
+                # All sent requests failed, fail over to the next endpoint
+                endpoint = self._choose(tried)
+                if endpoint:
+                    tried.append(endpoint)
+                    pending[self.executor.submit(self._call, endpoint, method, params)] = endpoint
+        raise error
+
+    def isConnected(self):
+        return any(e.provider.isConnected() for e in self.endpoints)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+class RoundSchedule:
+    """Start block and length of a Livepeer round (in mainnet blocks, as reported by the RoundManager)
+    and the blocks at which the given shares of the round have passed.
+    """
+
+    def __init__(self, round, start, length, shares=()):
+        self.round = round
+        self.start = start
+        self.length = length
+        self.end = start + length
+        self.deadlines = [(start + int(length * share), share) for share in shares]
+
+    def progress(self, block):
+        """Blocks since the start of the round
+        """
+        return block - self.start
+
+class TimerWheel:
+    """Hashed timer wheel keyed by block number.
+
+    add() is O(1), advance(block) only looks at the slots of the blocks since the previous advance
+    and returns the items which became due, in block order.
+    """
+
+    def __init__(self, slots=256):
+        self.slots = [[] for i in range(slots)]
+        self.block = None
+        # Items added for a block which was already passed, returned by the next advance
+        self.overdue = []
+
+    def add(self, block, item):
+        if self.block is not None and block <= self.block:
+            self.overdue.append((block, item))
+        else:
+            self.slots[block % len(self.slots)].append((block, item))
+
+    def advance(self, block):
+        if self.block is None or block - self.block >= len(self.slots):
+            indices = range(len(self.slots))
+        else:
+            indices = [b % len(self.slots) for b in range(self.block + 1, block + 1)]
+        due, self.overdue = self.overdue, []
+        for i in indices:
+            if any(b <= block for b, item in self.slots[i]):
+                due.extend(e for e in self.slots[i] if e[0] <= block)
+                self.slots[i] = [e for e in self.slots[i] if e[0] > block]
+        self.block = block if self.block is None else max(self.block, block)
+        return [item for b, item in sorted(due, key=lambda e: e[0])]
+
+    def next_block(self):
+        """Block of the earliest item, None if the wheel is empty
+        """
+        return min((b for slot in self.slots for b, item in slot), default=None)
+
+    def clear(self):
+        self.slots = [[] for i in self.slots]
+        self.overdue = []
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import bisect
+import hashlib
+import multiprocessing
+import queue
+
+def ring_point(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+class HashRing:
+    """Consistent hashing of keys (orchestrator addresses) to the shards 0..count-1.
+
+    Every shard gets replicas points on the ring, so the keys are spread evenly and only a small share
+    of them moves to another shard if the number of shards changes.
+    """
+
+    def __init__(self, count, replicas=100):
+        self.count = count
+        points = sorted((ring_point("{}-{}".format(shard, i)), shard) for shard in range(count) for i in range(replicas))
+        self.points = [p for p, shard in points]
+        self.shards = [shard for p, shard in points]
+
+    def shard(self, key):
+        return self.shards[bisect.bisect(self.points, ring_point(key.lower())) % len(self.points)]
+
+class ShardPool:
+    """Runs target(index, count, inbox, outbox) in count worker processes.
+
+    run() hands every shard its message and waits until all of them answered ("done", index, seq) or ("error", index, seq, text).
+    Shards which died are restarted before the next messages are sent.
+    """
+
+    def __init__(self, count, target, timeout=600):
+        self.count = count
+        self.target = target
+        self.timeout = timeout
+        self.ring = HashRing(count)
+        # Spawn instead of fork: the web3 connections and the store must not be shared with the children
+        self.context = multiprocessing.get_context("spawn")
+        self.inboxes = [self.context.Queue() for i in range(count)]
+        self.outbox = self.context.Queue()
+        self.processes = [None] * count
+        self.seq = 0
+
+    def start(self):
+        for index in range(self.count):
+            if not self.processes[index] or not self.processes[index].is_alive():
+                self.processes[index] = self.context.Process(target=self.target, args=(index, self.count, self.inboxes[index], self.outbox), daemon=True)
+                self.processes[index].start()
+        return self
+
+    def partition(self, events, key):
+        """Splits the events into one list per shard by key(event), events without key go to every shard
+        """
+        parts = [[] for i in range(self.count)]
+        for event in events:
+            k = key(event)
+            for index in ([self.ring.shard(k)] if k else range(self.count)):
+                parts[index].append(event)
+        return parts
+
+    def run(self, messages):
+        """Sends messages[index] to every shard and waits for all answers, raises if a shard failed
+        """
+        self.start()
+        self.seq += 1
+        for inbox, message in zip(self.inboxes, messages):
+            inbox.put((self.seq,) + message)
+        waiting = set(range(self.count))
+        errors = []
+        while waiting:
+            try:
+                kind, index, seq, *error = self.outbox.get(timeout=self.timeout)
+            except queue.Empty:
+                raise TimeoutError("Shards {} did not answer within {}s".format(sorted(waiting), self.timeout))
+            # Answers of an earlier, timed out run
+            if seq != self.seq:
+                continue
+            waiting.discard(index)
+            if kind == "error":
+                errors.append("Shard {}: {}".format(index, error[0]))
+        if errors:
+            raise RuntimeError("\n".join(errors))
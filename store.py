@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Default path of the shared database, the WATCHER_DB environment variable overrides it
+DB_FILE = "watcher.db"
+# Number of subscription changes kept for readers applying diffs, older readers reload everything
+CHANGES_KEPT = 10000
+# Window of update_ids remembered to recognize updates telegram sends again (webhook deliveries may arrive out of order)
+UPDATES_KEPT = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    transcoder TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    PRIMARY KEY (transcoder, chat_id)
+);
+CREATE INDEX IF NOT EXISTS subscriptions_chat_id ON subscriptions (chat_id);
+CREATE TABLE IF NOT EXISTS subscription_changes (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    transcoder TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    added INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tickets (
+    transcoder TEXT NOT NULL,
+    block INTEGER NOT NULL,
+    value REAL NOT NULL,
+    share REAL NOT NULL,
+    txHash TEXT,
+    logKey TEXT
+);
+CREATE INDEX IF NOT EXISTS tickets_transcoder ON tickets (transcoder);
+CREATE INDEX IF NOT EXISTS tickets_log ON tickets (txHash, logKey);
+CREATE TABLE IF NOT EXISTS processed_logs (
+    txHash TEXT NOT NULL,
+    logKey TEXT NOT NULL,
+    logIndex INTEGER NOT NULL,
+    block INTEGER NOT NULL,
+    blockHash TEXT NOT NULL,
+    topics TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (txHash, logKey)
+);
+CREATE INDEX IF NOT EXISTS processed_logs_block ON processed_logs (block);
+CREATE TABLE IF NOT EXISTS reward_calls (
+    txHash TEXT NOT NULL,
+    logKey TEXT NOT NULL,
+    round INTEGER NOT NULL,
+    transcoder TEXT NOT NULL,
+    block INTEGER NOT NULL,
+    tokens REAL NOT NULL,
+    PRIMARY KEY (txHash, logKey)
+);
+CREATE INDEX IF NOT EXISTS reward_calls_transcoder ON reward_calls (transcoder, round);
+CREATE TABLE IF NOT EXISTS ticket_redemptions (
+    txHash TEXT NOT NULL,
+    logKey TEXT NOT NULL,
+    round INTEGER NOT NULL,
+    transcoder TEXT NOT NULL,
+    block INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (txHash, logKey)
+);
+CREATE INDEX IF NOT EXISTS ticket_redemptions_transcoder ON ticket_redemptions (transcoder, round);
+CREATE TABLE IF NOT EXISTS active_transcoders (
+    round INTEGER NOT NULL,
+    transcoder TEXT NOT NULL,
+    PRIMARY KEY (transcoder, round)
+);
+CREATE INDEX IF NOT EXISTS active_transcoders_round ON active_transcoders (round);
+CREATE TABLE IF NOT EXISTS pending_updates (
+    update_id INTEGER PRIMARY KEY,
+    body TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS received_updates (
+    update_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transcoders (
+    address TEXT PRIMARY KEY,
+    rewardCalled INTEGER NOT NULL,
+    isActive INTEGER NOT NULL
+);
+"""
+
+def log_key(topics, data, position=0):
+    """Identifies a log within its transaction by its topics and data (hex strings) and its position among the identical
+    logs of the transaction (e.g. the tickets of a batch redemption), counted in logIndex order.
+
+    Unlike the logIndex (the position within the block), the key stays the same if the transaction
+    is included in another block after a reorg.
+    """
+    return hashlib.sha256(json.dumps([topics, data, position]).encode()).hexdigest()[:32]
+
+class Store:
+    """SQLite (WAL) store for the state shared by orchestrator-watcher.py and telegram-subscriptions.py.
+
+    Every method runs in its own transaction unless it is called inside a transaction() block,
+    in which case everything is committed (or rolled back) together.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("WATCHER_DB", DB_FILE)
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.RLock()
+        self.depth = 0
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """Nested transactions are part of the outer one.
+
+        Use immediate for transactions which read before they write: the write lock is taken right away,
+        otherwise SQLite fails the first write if the other script committed since the read.
+        """
+        with self.lock:
+            if self.depth == 0:
+                # Deferred by default, the write lock is only taken by the first write
+                self.conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            self.depth += 1
+            try:
+                yield self.conn
+            except BaseException:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.conn.execute("ROLLBACK")
+                raise
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.conn.execute("COMMIT")
+
+    # Checkpoints
+
+    def get_checkpoint(self, name, default=None):
+        with self.transaction() as c:
+            row = c.execute("SELECT value FROM checkpoints WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
+
+    def set_checkpoint(self, name, value):
+        with self.transaction() as c:
+            c.execute("INSERT OR REPLACE INTO checkpoints (name, value) VALUES (?, ?)", (name, value))
+
+    # Subscriptions
+
+    def get_subscriptions(self):
+        """Returns (version, subscriptions) with subscriptions as dict transcoder -> list of chat_ids
+        """
+        subscriptions = {}
+        with self.transaction() as c:
+            version = c.execute("SELECT COALESCE(MAX(version), 0) FROM subscription_changes").fetchone()[0]
+            for transcoder, chat_id in c.execute("SELECT transcoder, chat_id FROM subscriptions ORDER BY rowid"):
+                subscriptions.setdefault(transcoder, []).append(chat_id)
+        return version, subscriptions
+
+    def get_subscription_changes(self, version):
+        """Returns (newVersion, changes) with the list of (transcoder, chat_id, added) changes after the given version.
+
+        changes is None if the changes are no longer available and the subscriptions have to be reloaded.
+        """
+        with self.transaction() as c:
+            oldest, newest = c.execute("SELECT MIN(version), MAX(version) FROM subscription_changes").fetchone()
+            if newest is None or newest == version:
+                return version, []
+            if version < oldest - 1 or version > newest:
+                return newest, None
+            changes = c.execute("SELECT transcoder, chat_id, added FROM subscription_changes WHERE version > ? AND version <= ? ORDER BY version",
+                (version, newest)).fetchall()
+        return newest, [(t, chat_id, bool(added)) for t, chat_id, added in changes]
+
+    def _log_change(self, c, transcoder, chat_id, added):
+        version = c.execute("INSERT INTO subscription_changes (transcoder, chat_id, added) VALUES (?, ?, ?)", (transcoder, chat_id, int(added))).lastrowid
+        c.execute("DELETE FROM subscription_changes WHERE version <= ?", (version - CHANGES_KEPT,))
+
+    def add_subscription(self, transcoder, chat_id):
+        """Returns False if the chat was already subscribed to the transcoder
+        """
+        with self.transaction() as c:
+            if c.execute("INSERT OR IGNORE INTO subscriptions (transcoder, chat_id) VALUES (?, ?)", (transcoder, chat_id)).rowcount == 0:
+                return False
+            self._log_change(c, transcoder, chat_id, True)
+        return True
+
+    def remove_subscription(self, transcoder, chat_id):
+        """Returns False if the chat was not subscribed to the transcoder
+        """
+        with self.transaction() as c:
+            if c.execute("DELETE FROM subscriptions WHERE transcoder = ? AND chat_id = ?", (transcoder, chat_id)).rowcount == 0:
+                return False
+            self._log_change(c, transcoder, chat_id, False)
+        return True
+
+    # Winning tickets
+
+    def add_ticket(self, transcoder, block, value, share, txHash=None, logKey=None):
+        """Adds a winning ticket and returns the sums (value, share) since the last payout notification
+        """
+        with self.transaction() as c:
+            c.execute("INSERT INTO tickets (transcoder, block, value, share, txHash, logKey) VALUES (?, ?, ?, ?, ?, ?)",
+                (transcoder, block, value, share, txHash, logKey))
+            return c.execute("SELECT SUM(value), SUM(share) FROM tickets WHERE transcoder = ?", (transcoder,)).fetchone()
+
+    def clear_tickets(self, transcoder):
+        with self.transaction() as c:
+            c.execute("DELETE FROM tickets WHERE transcoder = ?", (transcoder,))
+
+    def remove_ticket(self, txHash, logKey):
+        """Removes the winning ticket of the given log, returns False if there is none (already paid out)
+        """
+        with self.transaction() as c:
+            return c.execute("DELETE FROM tickets WHERE txHash = ? AND logKey = ?", (txHash, logKey)).rowcount > 0
+
+    # Processed logs
+
+    def add_processed_log(self, txHash, logKey, logIndex, block, blockHash, topics, data):
+        """Remembers the log, returns False if it was already processed.
+
+        Logs are keyed by transaction hash and log_key(), so a log whose transaction was included in another block
+        after a reorg keeps its key and only its position is updated.
+        """
+        with self.transaction() as c:
+            if c.execute("INSERT OR IGNORE INTO processed_logs (txHash, logKey, logIndex, block, blockHash, topics, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (txHash, logKey, logIndex, block, blockHash, json.dumps(topics), data)).rowcount:
+                return True
+            c.execute("UPDATE processed_logs SET logIndex = ?, block = ?, blockHash = ? WHERE txHash = ? AND logKey = ?",
+                (logIndex, block, blockHash, txHash, logKey))
+        return False
+
+    def is_processed_log(self, txHash, logKey):
+        with self.transaction() as c:
+            return c.execute("SELECT 1 FROM processed_logs WHERE txHash = ? AND logKey = ?", (txHash, logKey)).fetchone() is not None
+
+    def get_processed_logs(self, fromBlock, toBlock):
+        """Returns the processed logs between fromBlock and toBlock as (txHash, logKey, logIndex, block, blockHash, topics, data)
+        """
+        with self.transaction() as c:
+            rows = c.execute("SELECT txHash, logKey, logIndex, block, blockHash, topics, data FROM processed_logs WHERE block >= ? AND block <= ? ORDER BY block, logIndex",
+                (fromBlock, toBlock)).fetchall()
+        return [row[:5] + (json.loads(row[5]), row[6]) for row in rows]
+
+    def remove_processed_log(self, txHash, logKey):
+        """Forgets a log which was removed in a reorg, returns False if it was not processed
+        """
+        with self.transaction() as c:
+            return c.execute("DELETE FROM processed_logs WHERE txHash = ? AND logKey = ?", (txHash, logKey)).rowcount > 0
+
+    def prune_processed_logs(self, block):
+        """Forgets the logs before the given block
+        """
+        with self.transaction() as c:
+            c.execute("DELETE FROM processed_logs WHERE block < ?", (block,))
+
+    # Event index, kept for the statistics
+
+    def add_reward_call(self, txHash, logKey, round, transcoder, block, tokens):
+        with self.transaction() as c:
+            c.execute("INSERT OR IGNORE INTO reward_calls (txHash, logKey, round, transcoder, block, tokens) VALUES (?, ?, ?, ?, ?, ?)",
+                (txHash, logKey, round, transcoder, block, tokens))
+
+    def add_ticket_redemption(self, txHash, logKey, round, transcoder, block, value):
+        with self.transaction() as c:
+            c.execute("INSERT OR IGNORE INTO ticket_redemptions (txHash, logKey, round, transcoder, block, value) VALUES (?, ?, ?, ?, ?, ?)",
+                (txHash, logKey, round, transcoder, block, value))
+
+    def add_active_transcoders(self, round, transcoders):
+        """Stores the active set of the round
+        """
+        with self.transaction() as c:
+            c.executemany("INSERT OR IGNORE INTO active_transcoders (round, transcoder) VALUES (?, ?)", [(round, t) for t in transcoders])
+
+    def get_last_active_transcoders(self):
+        """Returns the active set of the last stored round
+        """
+        with self.transaction() as c:
+            return [row[0] for row in c.execute("SELECT transcoder FROM active_transcoders WHERE round = (SELECT MAX(round) FROM active_transcoders)")]
+
+    def remove_indexed_event(self, txHash, logKey):
+        """Removes a reward call or ticket redemption which was removed in a reorg.
+
+        Returns the round of the removed reward call, None if it was not a stored reward call.
+        """
+        with self.transaction() as c:
+            row = c.execute("SELECT round FROM reward_calls WHERE txHash = ? AND logKey = ?", (txHash, logKey)).fetchone()
+            c.execute("DELETE FROM reward_calls WHERE txHash = ? AND logKey = ?", (txHash, logKey))
+            c.execute("DELETE FROM ticket_redemptions WHERE txHash = ? AND logKey = ?", (txHash, logKey))
+        return row[0] if row else None
+
+    def get_transcoder_stats(self, transcoder, fromRound):
+        """Returns the statistics of the transcoder from fromRound on (or the first indexed round) as dict with
+        firstRound, activeRounds, rewardRounds, rewards (LPT), tickets, fees (ETH), feeRounds (rounds with fees)
+        and indexed (False until the active set of a round was stored)
+        """
+        with self.transaction() as c:
+            firstRound = c.execute("SELECT MIN(round) FROM active_transcoders").fetchone()[0]
+            indexed = firstRound is not None
+            if not indexed:
+                # Until the first round change, only the events since the upgrade are indexed
+                firstRound = c.execute("SELECT MIN(round) FROM (SELECT round FROM reward_calls UNION ALL SELECT round FROM ticket_redemptions)").fetchone()[0]
+            fromRound = max(fromRound, firstRound or fromRound)
+            activeRounds = c.execute("SELECT COUNT(*) FROM active_transcoders WHERE transcoder = ? AND round >= ?", (transcoder, fromRound)).fetchone()[0]
+            rewardRounds, rewards = c.execute("SELECT COUNT(DISTINCT round), COALESCE(SUM(tokens), 0) FROM reward_calls WHERE transcoder = ? AND round >= ?",
+                (transcoder, fromRound)).fetchone()
+            tickets, fees, feeRounds = c.execute("SELECT COUNT(*), COALESCE(SUM(value), 0), COUNT(DISTINCT round) FROM ticket_redemptions WHERE transcoder = ? AND round >= ?",
+                (transcoder, fromRound)).fetchone()
+        return {"firstRound": fromRound, "indexed": indexed, "activeRounds": activeRounds, "rewardRounds": rewardRounds, "rewards": rewards,
+            "tickets": tickets, "fees": fees, "feeRounds": feeRounds}
+
+    # Telegram updates
+
+    def add_updates(self, updates):
+        """Keeps the updates until they are handled and returns the ones which were not received before.
+
+        Received update_ids are remembered for the last UPDATES_KEPT ids, older ones count as received.
+        The highest received update_id is stored as checkpoint "telegramUpdateId" (the getUpdates offset).
+        """
+        with self.transaction(immediate=True) as c:
+            last = self.get_checkpoint("telegramUpdateId", 0)
+            new = [u for u in updates if u["update_id"] > last - UPDATES_KEPT
+                and c.execute("INSERT OR IGNORE INTO received_updates (update_id) VALUES (?)", (u["update_id"],)).rowcount]
+            c.executemany("INSERT OR IGNORE INTO pending_updates (update_id, body) VALUES (?, ?)", [(u["update_id"], json.dumps(u)) for u in new])
+            if new:
+                last = max([last] + [u["update_id"] for u in new])
+                self.set_checkpoint("telegramUpdateId", last)
+                c.execute("DELETE FROM received_updates WHERE update_id <= ?", (last - UPDATES_KEPT,))
+        return new
+
+    def remove_update(self, update_id):
+        with self.transaction() as c:
+            c.execute("DELETE FROM pending_updates WHERE update_id = ?", (update_id,))
+
+    def get_pending_updates(self):
+        """Returns the received but not yet handled updates, in order
+        """
+        with self.transaction() as c:
+            return [json.loads(body) for (body,) in c.execute("SELECT body FROM pending_updates ORDER BY update_id")]
+
+    # Notification outbox
+
+    def add_outbox(self, messages):
+        """Keeps the (text, chat_id) messages until they are delivered, returns their ids
+        """
+        with self.transaction() as c:
+            return [c.execute("INSERT INTO outbox (chat_id, text) VALUES (?, ?)", (chat_id, text)).lastrowid for text, chat_id in messages]
+
+    def remove_outbox(self, id):
+        with self.transaction() as c:
+            c.execute("DELETE FROM outbox WHERE id = ?", (id,))
+
+    def get_outbox(self):
+        """Returns the messages which are not delivered yet as (id, text, chat_id), in order
+        """
+        with self.transaction() as c:
+            return c.execute("SELECT id, text, chat_id FROM outbox ORDER BY id").fetchall()
+
+    # Transcoder flags
+
+    def get_transcoder_flags(self, address):
+        """Returns (rewardCalled, isActive) or None if the transcoder is unknown
+        """
+        with self.transaction() as c:
+            row = c.execute("SELECT rewardCalled, isActive FROM transcoders WHERE address = ?", (address,)).fetchone()
+        return (bool(row[0]), bool(row[1])) if row else None
+
+    def set_transcoder_flags(self, transcoders):
+        """Stores the rewardCalled/isActive flags of the given Transcoder instances
+        """
+        with self.transaction() as c:
+            c.executemany("INSERT OR REPLACE INTO transcoders (address, rewardCalled, isActive) VALUES (?, ?, ?)",
+                [(t.address, int(t.rewardCalled), int(t.isActive)) for t in transcoders])
+
+    def remove_transcoder_flags(self, addresses):
+        """Deletes the stored flags of the given transcoder addresses
+        """
+        with self.transaction() as c:
+            c.executemany("DELETE FROM transcoders WHERE address = ?", [(address,) for address in addresses])
+
+    # Orchestrator state, moved between the databases of the shards when their number changes
+
+    def get_orchestrator_state(self):
+        """Returns the rows of the transcoders, tickets and processed_logs tables as (flags, tickets, logs)
+        """
+        with self.transaction() as c:
+            flags = c.execute("SELECT address, rewardCalled, isActive FROM transcoders").fetchall()
+            tickets = c.execute("SELECT transcoder, block, value, share, txHash, logKey FROM tickets ORDER BY rowid").fetchall()
+            logs = c.execute("SELECT txHash, logKey, logIndex, block, blockHash, topics, data FROM processed_logs").fetchall()
+        return flags, tickets, [row[:5] + (json.loads(row[5]), row[6]) for row in logs]
+
+    def replace_orchestrator_state(self, flags, tickets, logs, checkpoints):
+        """Replaces the transcoder flags, tickets and processed logs (and drops the outbox), sets the given checkpoints (dict name -> value)
+        """
+        with self.transaction() as c:
+            for table in ("transcoders", "tickets", "processed_logs", "outbox"):
+                c.execute("DELETE FROM {}".format(table))
+            c.executemany("INSERT INTO transcoders (address, rewardCalled, isActive) VALUES (?, ?, ?)", flags)
+            c.executemany("INSERT INTO tickets (transcoder, block, value, share, txHash, logKey) VALUES (?, ?, ?, ?, ?, ?)", tickets)
+            c.executemany("INSERT INTO processed_logs (txHash, logKey, logIndex, block, blockHash, topics, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [row[:5] + (json.dumps(row[5]), row[6]) for row in logs])
+            c.executemany("INSERT OR REPLACE INTO checkpoints (name, value) VALUES (?, ?)", [(k, v) for k, v in checkpoints.items() if v is not None])
+
+###
+# Migration from the record files
+###
+
+def read_last_line(path):
+    with open(path, "rb") as fh:
+        # Only read the end of the file, the record files are append-only
+        fh.seek(0, 2)
+        fh.seek(max(0, fh.tell() - 64))
+        return int(fh.read().split()[-1])
+
+def migrate(store, path="."):
+    """One-shot import of the block/round record files, the subscriptions and the winning tickets into the store.
+
+    Does nothing if the store already contains checkpoints.
+    """
+    if store.get_checkpoint("arbitrumBlock") is not None:
+        print("Store already initialized, nothing to migrate")
+        return False
+    with open(path + "/transcoder_subscriptions.json") as f:
+        subscriptions = json.load(f)
+    with open(path + "/winning_tickets.json") as f:
+        wt = json.load(f)
+    with store.transaction():
+        store.set_checkpoint("mainnetBlock", read_last_line(path + "/mainnet_block_records.txt"))
+        store.set_checkpoint("arbitrumBlock", read_last_line(path + "/arbitrum_block_records.txt"))
+        store.set_checkpoint("roundNr", read_last_line(path + "/roundNr_records.txt"))
+        for transcoder, chat_ids in subscriptions.items():
+            for chat_id in chat_ids:
+                store.add_subscription(transcoder, chat_id)
+        for transcoder, tickets in wt.items():
+            for value, share in zip(tickets["value"], tickets["share"]):
+                store.add_ticket(transcoder, 0, value, share)
+    print("Migrated record files into {}".format(store.path))
+    return True
+
+if __name__ == '__main__':
+    migrate(Store())
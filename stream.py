@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import queue
+import threading
+import websockets
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.datastructures import AttributeDict
+
+def format_log(raw):
+    """Formats a raw log of an eth_subscribe notification like web3 formats the result of eth_getLogs
+    """
+    return AttributeDict({
+        "address": Web3.toChecksumAddress(raw["address"]),
+        "topics": [HexBytes(t) for t in raw["topics"]],
+        "data": raw["data"],
+        "blockNumber": int(raw["blockNumber"], 16),
+        "blockHash": HexBytes(raw["blockHash"]),
+        "transactionHash": HexBytes(raw["transactionHash"]),
+        "transactionIndex": int(raw["transactionIndex"], 16),
+        "logIndex": int(raw["logIndex"], 16),
+        "removed": raw.get("removed", False),
+    })
+
+class LogStream:
+    """Subscribes to the logs of the given contracts/topics and to newHeads over a websocket.
+
+    Runs an asyncio loop in a background thread and puts (kind, value) tuples into the events queue:
+    ("connected", None), ("log", log), ("head", blockNumber) and ("disconnected", error).
+    Reconnects automatically (to the next of the given websocket urls), the consumer is expected to fill the gap
+    with eth_getLogs after ("connected", None).
+    """
+
+    def __init__(self, urls, addresses, topics, reconnectDelay=5, maxReconnectDelay=300):
+        if not urls:
+            raise ValueError("LogStream needs at least one websocket url")
+        self.urls = list(urls)
+        self.addresses = addresses
+        self.topics = topics
+        self.reconnectDelay = reconnectDelay
+        self.maxReconnectDelay = maxReconnectDelay
+        self.events = queue.Queue()
+        self.delay = reconnectDelay
+        self.thread = None
+
+    def start(self):
+        if not self.thread:
+            self.thread = threading.Thread(target=asyncio.run, args=(self._run(),), daemon=True)
+            self.thread.start()
+        return self
+
+    async def _run(self):
+        self.delay = self.reconnectDelay
+        while True:
+            try:
+                await self._listen()
+                self.events.put(("disconnected", "connection closed"))
+            except Exception as ex:
+                self.events.put(("disconnected", str(ex)))
+            self.urls.append(self.urls.pop(0))
+            await asyncio.sleep(self.delay)
+            self.delay = min(self.delay * 2, self.maxReconnectDelay)
+
+    async def _listen(self):
+        async with websockets.connect(self.urls[0], max_size=None) as ws:
+            requests = {
+                1: ("log", ["logs", {"address": self.addresses, "topics": [self.topics]}]),
+                2: ("head", ["newHeads"]),
+            }
+            for id, (kind, params) in requests.items():
+                await ws.send(json.dumps({"jsonrpc": "2.0", "id": id, "method": "eth_subscribe", "params": params}))
+            subscriptions = {}
+            async for message in ws:
+                message = json.loads(message)
+                if message.get("id") in requests:
+                    if "error" in message:
+                        raise ValueError("eth_subscribe failed: {}".format(message["error"]))
+                    subscriptions[message["result"]] = requests[message["id"]][0]
+                    if len(subscriptions) == len(requests):
+                        self.events.put(("connected", None))
+                        # Connection is healthy again
+                        self.delay = self.reconnectDelay
+                    continue
+                params = message.get("params", {})
+                kind = subscriptions.get(params.get("subscription"))
+                if kind == "log":
+                    self.events.put(("log", format_log(params["result"])))
+                elif kind == "head":
+                    self.events.put(("head", int(params["result"]["number"], 16)))
@@ -1,17 +1,73 @@
 #!/usr/bin/env python3
 
+import asyncio
 import json
+import queue
 import requests
+import secrets
+import sqlite3
+import sys
+import threading
 import time
+from aiohttp import web
+from collections import deque
+from concurrent.futures import Future
 from web3 import Web3
-from setup import WS_ARBITRUM_ALCHEMY, TEL_URL, MY_TELEGRAM_ID, send_message, BONDING_MANAGER_PROXY, BONDING_MANAGER_ABI
+from setup import ARBITRUM_ENDPOINTS, TEL_URL, MY_TELEGRAM_ID, send_message, BONDING_MANAGER_PROXY, BONDING_MANAGER_ABI
+from store import Store
+from notifier import Notifier
+from metrics import Counter, Histogram, function_selectors, rpc_metrics_middleware, start_server
+from rpcpool import ProviderPool, set_budget_share
 
-w3 = Web3(Web3.WebsocketProvider(WS_ARBITRUM_ALCHEMY))
+w3 = Web3(ProviderPool(ARBITRUM_ENDPOINTS))
 
+###
+# Variables
+###
+
+# Updates are handled by this many worker threads, all updates of a chat by the same worker (keeps their order)
+workers = 8
+# Maximum number of queued updates per worker, the long poll waits if a worker is behind
+worker_queue_size = 100
+# Attempts to remove a handled update while watcher.db is locked (each waits up to 30s for the lock)
+remove_retries = 5
+# Seconds the result of isRegisteredTranscoder is cached
+registered_ttl = 3600
+not_registered_ttl = 60
+# Subscription changes arriving within this many seconds are written in one transaction
+batch_interval = 0.2
+# Number of rounds the stats command covers
+stats_rounds = 30
+# Prometheus metrics are served on http://127.0.0.1:<metrics_port>/metrics
+metrics_port = 9102
+# Webhook mode (--webhook <public https url>): the url has to be forwarded to this address
+webhook_address = "127.0.0.1"
+webhook_port = 8443
+# Share of the endpoint request budgets this script uses, the rest is left to orchestrator-watcher.py
+rpc_budget_share = 0.1
+
+set_budget_share(rpc_budget_share)
 bonding_manager_proxy = w3.eth.contract(address=BONDING_MANAGER_PROXY, abi=json.loads(BONDING_MANAGER_ABI))
+w3.middleware_onion.add(rpc_metrics_middleware(function_selectors(bonding_manager_proxy)))
+# Shared with orchestrator-watcher.py
+store = Store()
+# Reverse index chat_id -> subscribed transcoders, this script is the only one changing the subscriptions
+chatSubscriptions = {}
+indexLock = threading.Lock()
+# Replies are delivered in the background, respecting the telegram rate limits
+notifier = Notifier()
+# Long polling connection to the telegram API
+updatesSession = requests.Session()
+
+def load_chat_subscriptions():
+    version, subscriptions = store.get_subscriptions()
+    chatSubscriptions.clear()
+    for transcoder, chat_ids in subscriptions.items():
+        for chat_id in chat_ids:
+            chatSubscriptions.setdefault(chat_id, []).append(transcoder)
 
 def get_json_from_url(url):
-    content = requests.get(url).content.decode("utf8")
+    content = updatesSession.get(url, timeout=90).content.decode("utf8")
     js = json.loads(content)
     return js
 
@@ -26,108 +82,325 @@ def get_last_update_id(updates):
     last_id = updates["result"][-1]["update_id"]
     return last_id
 
-def handleSubscription(subscriptions, chat_id, transcoderChecksum):
+def call_api(method, **params):
+    js = updatesSession.post(TEL_URL + method, data=params, timeout=30).json()
+    if not js.get("ok"):
+        raise ValueError("{} failed: {}".format(method, js.get("description")))
+    return js
+
+###
+# Registered transcoders cache, batched subscription writes & latency stats
+###
+
+registeredCache = {}
+
+def isRegisteredTranscoder(transcoderChecksum):
+    """isRegisteredTranscoder() with a TTL cache, negative results expire sooner
+    """
+    entry = registeredCache.get(transcoderChecksum)
+    if entry and entry[1] > time.time():
+        REGISTERED_CACHE.inc(result="hit")
+        return entry[0]
+    REGISTERED_CACHE.inc(result="miss")
+    # The provider pool serializes the requests per endpoint
+    registered = bonding_manager_proxy.functions.isRegisteredTranscoder(transcoderChecksum).call()
+    registeredCache[transcoderChecksum] = (registered, time.time() + (registered_ttl if registered else not_registered_ttl))
+    return registered
+
+class SubscriptionWriter:
+    """Collects subscription changes of all workers and writes them in one store transaction per batch_interval.
+
+    submit() returns a Future with the result of store.add_subscription/remove_subscription once the batch is committed.
+    """
+
+    def __init__(self):
+        self.changes = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, add, transcoderChecksum, chat_id):
+        future = Future()
+        self.changes.put((add, transcoderChecksum, chat_id, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.changes.get()]
+            end = time.time() + batch_interval
+            while time.time() < end:
+                try:
+                    batch.append(self.changes.get(timeout=end - time.time()))
+                except queue.Empty:
+                    break
+            try:
+                with store.transaction():
+                    results = [store.add_subscription(t, c) if add else store.remove_subscription(t, c) for add, t, c, f in batch]
+            except Exception as ex:
+                for add, t, c, future in batch:
+                    future.set_exception(ex)
+                continue
+            for (add, t, c, future), result in zip(batch, results):
+                future.set_result(result)
+
+subscriptionWriter = SubscriptionWriter()
+
+COMMAND_LATENCY = Histogram("bot_command_seconds", "Seconds from receiving an update until it was handled")
+UPDATES = Counter("bot_updates_total", "Received telegram updates")
+REGISTERED_CACHE = Counter("bot_registered_cache_total", "Lookups of the isRegisteredTranscoder cache per result")
+
+# Latency of the last handled commands (seconds from receiving the update until it was handled)
+latencies = deque(maxlen=1000)
+latencyLock = threading.Lock()
+handledCommands = 0
+
+def record_latency(seconds):
+    global handledCommands
+    COMMAND_LATENCY.observe(seconds)
+    with latencyLock:
+        latencies.append(seconds)
+        handledCommands += 1
+        if handledCommands % 100 == 0:
+            values = sorted(latencies)
+            print("Command latency p50: {:.3f}s, p99: {:.3f}s".format(values[len(values)//2], values[int(len(values)*0.99)]))
+
+def handleSubscription(chat_id, transcoderChecksum):
     """Handles adding a subscription
     Cases: 
     1) transcoder & chat_id is already in subscriptions: do nothing
-    2) t is in subscriptions but not c: append c to t
-    3) t is not in subscriptions: add t & c
+    2) otherwise: add t & c
     """
-    if subscriptions.get(transcoderChecksum):
-        if chat_id in subscriptions[transcoderChecksum]:
-            send_message("You are already subscribed to this address", chat_id)
-            return
-        else:
-            subscriptions[transcoderChecksum].append(chat_id)
-    else:
-        subscriptions[transcoderChecksum] = [chat_id]
-    with open("transcoder_subscriptions.json", "w") as f:
-        json.dump(subscriptions, f, indent=1)
-    send_message("Subscription added, you will now be notified about events of {}".format(transcoderChecksum), chat_id)
+    if transcoderChecksum in chatSubscriptions.get(chat_id, []) or not subscriptionWriter.submit(True, transcoderChecksum, chat_id).result():
+        notifier.send("You are already subscribed to this address", chat_id)
+        return
+    with indexLock:
+        chatSubscriptions.setdefault(chat_id, []).append(transcoderChecksum)
+    notifier.send("Subscription added, you will now be notified about events of {}".format(transcoderChecksum), chat_id)
 
-def handleUnsubscribe(subscriptions, chat_id, transcoderChecksum):
+def handleUnsubscribe(chat_id, transcoderChecksum):
     """Handles subscription removal
 
     Check if the chat_id is subscribed to the transcoder.
     If true: delete chat_id from transcoder. 
-    If the transcoder has no subscribers, remove the transcoder.
     """
-    if chat_id in subscriptions[transcoderChecksum]:
-        subscriptions[transcoderChecksum].remove(chat_id)
-        if not subscriptions[transcoderChecksum]:
-            del subscriptions[transcoderChecksum]
-        with open("transcoder_subscriptions.json", "w") as f:
-            json.dump(subscriptions, f, indent=1)
-        send_message("You are now unsubscribed from orchestrator {}".format(transcoderChecksum), chat_id)
+    if transcoderChecksum in chatSubscriptions.get(chat_id, []) and subscriptionWriter.submit(False, transcoderChecksum, chat_id).result():
+        with indexLock:
+            chatSubscriptions[chat_id].remove(transcoderChecksum)
+            if not chatSubscriptions[chat_id]:
+                del chatSubscriptions[chat_id]
+        notifier.send("You are now unsubscribed from orchestrator {}".format(transcoderChecksum), chat_id)
     else:
-        send_message("You are not subscribed to this orchestrator", chat_id)
+        notifier.send("You are not subscribed to this orchestrator", chat_id)
 
 
 def getTranscoder_IfValid(message, chat_id):
     transcoderAddr = message[message.find("0x"):message.find("0x")+42]
     if w3.isAddress(transcoderAddr):
         transcoderChecksum = w3.toChecksumAddress(transcoderAddr)
-        if bonding_manager_proxy.functions.isRegisteredTranscoder(transcoderChecksum).call():
+        if isRegisteredTranscoder(transcoderChecksum):
             return transcoderChecksum
         else:
-            send_message("The entered address is not a registered orchestrator. Please try again", chat_id)
+            notifier.send("The entered address is not a registered orchestrator. Please try again", chat_id)
     else:
-        send_message("The entered address is not valid. Please try again", chat_id)
+        notifier.send("The entered address is not valid. Please try again", chat_id)
 
 def getTranscoder(message):
     transcoderChecksum = w3.toChecksumAddress(message[message.find("0x"):message.find("0x")+42])
     return transcoderChecksum
 
 def displaySubscriptions(chat_id):
-    with open("transcoder_subscriptions.json", "r") as f:
-        subscriptions = json.load(f)
-    message = [t for t, cid in subscriptions.items() if chat_id in cid]
-    send_message("You are subscribed to the following orchestrators:\n" + "\n".join(message), chat_id)
+    message = chatSubscriptions.get(chat_id, [])
+    notifier.send("You are subscribed to the following orchestrators:\n" + "\n".join(message), chat_id)
 
-def checkMessage(updates):
-    for update in updates["result"]:
+def displayStats(chat_id, transcoderChecksum):
+    """Answers the stats command from the event index of orchestrator-watcher.py
+    """
+    roundNr = store.get_checkpoint("roundNr", 0)
+    stats = store.get_transcoder_stats(transcoderChecksum, roundNr - stats_rounds + 1)
+    if not stats["activeRounds"] and not stats["rewardRounds"] and not stats["tickets"]:
+        notifier.send("There are no statistics for orchestrator {} since round {} yet".format(transcoderChecksum, stats["firstRound"]), chat_id)
+        return
+    rounds = max(1, roundNr - stats["firstRound"] + 1)
+    if stats["indexed"]:
+        rewardStats = "Rewards claimed in {rewardRounds} of {activeRounds} active rounds ({reliability}%), {rewards} LPT in total".format(
+            rewardRounds = stats["rewardRounds"], activeRounds = stats["activeRounds"],
+            reliability = round(100*stats["rewardRounds"]/stats["activeRounds"]) if stats["activeRounds"] else 0,
+            rewards = round(stats["rewards"], 2))
+    else:
+        # The active set is stored from the next round change on
+        rewardStats = "{rewards} LPT rewards claimed, no data on the reward call reliability until the next round".format(
+            rewards = round(stats["rewards"], 2))
+    notifier.send("Statistics of orchestrator {address} for the last {rounds} rounds (since round {firstRound}):\n" \
+        " - {rewardStats}\n" \
+        " - {tickets} winning tickets in {feeRounds} rounds, {fees} ETH in total ({feesPerRound} ETH per round)".format(
+            address = transcoderChecksum, rounds = rounds, firstRound = stats["firstRound"], rewardStats = rewardStats,
+            tickets = stats["tickets"], feeRounds = stats["feeRounds"],
+            fees = round(stats["fees"], 4), feesPerRound = round(stats["fees"]/rounds, 4)), chat_id)
+
+def handleUpdate(update):
+    """Handles the command of a single update
+    """
+    try:
+        message = update["message"]["text"]
+        chat_id = update["message"]["chat"]["id"]
+        if message == "/start":
+            notifier.send("Welcome to the Orchestrator-Watcher bot!\n\nThis bot is provided by the " \
+                "[0x525-Transcoder](https://forum.livepeer.org/t/transcoder-campaign-0x525-with-telegram-bot/588), " \
+                "Discord: vires-in-numeris. Tips to 0x525419FF5707190389bfb5C87c375D710F5fCb0E are appreciated, thank you!\n\n" \
+                "The following commands are available:\n - *subscribe* <orchestrator address>\n - *remove* <orchestrator address>\n - " \
+                "*subscriptions*\n - *stats* <orchestrator address>\n\nPlease enter *subscribe* followed by the orchestrator address " \
+                "(e.g. 'subscribe 0x525419FF5707190389bfb5C87c375D710F5fCb0E') to get notified about the following events:\n - " \
+                "reward calls\n - missed reward calls\n - when the reward/fee cut changes\n - orchestrator becomes inactive\n\n" \
+                "If you no longer want to be notified, enter *remove* followed the orchestrator address.\n\n" \
+                "If you want to check your subscriptions, enter *subscriptions*.\n\n" \
+                "For the reward calls and fees of an orchestrator in the last {} rounds, enter *stats* followed by the orchestrator address.".format(stats_rounds), chat_id)
+        elif "subscribe" in message.lower() and "0x" in message:
+            transcoderChecksum = getTranscoder_IfValid(message, chat_id)
+            if transcoderChecksum:
+                handleSubscription(chat_id, transcoderChecksum)
+        elif "remove" in message.lower() and "0x" in message:
+            transcoderChecksum = getTranscoder_IfValid(message, chat_id)
+            if transcoderChecksum:
+                handleUnsubscribe(chat_id, transcoderChecksum)
+        elif "stats" in message.lower() and "0x" in message:
+            transcoderChecksum = getTranscoder_IfValid(message, chat_id)
+            if transcoderChecksum:
+                displayStats(chat_id, transcoderChecksum)
+        elif "subscriptions" in message.lower():
+            displaySubscriptions(chat_id)
+        else:
+            notifier.send("The following commands are available:\n - *subscribe* <orchestrator address>\n - *remove* <orchestrator address>\n - *subscriptions*\n - *stats* <orchestrator address>", chat_id)
+    except Exception as ex:
+        print(ex)
+        send_message(ex, MY_TELEGRAM_ID)
+
+queues = []
+
+def worker(updates):
+    while True:
+        update, received = updates.get()
+        handleUpdate(update)
+        # The worker must survive, otherwise its queue fills up and blocks the updates of all its chats
         try:
-            message = update["message"]["text"]
-            chat_id = update["message"]["chat"]["id"]
-            if message == "/start":
-                send_message("Welcome to the Orchestrator-Watcher bot!\n\nThis bot is provided by the " \
-                    "[0x525-Transcoder](https://forum.livepeer.org/t/transcoder-campaign-0x525-with-telegram-bot/588), " \
-                    "Discord: vires-in-numeris. Tips to 0x525419FF5707190389bfb5C87c375D710F5fCb0E are appreciated, thank you!\n\n" \
-                    "The following commands are available:\n - *subscribe* <orchestrator address>\n - *remove* <orchestrator address>\n - " \
-                    "*subscriptions*\n\nPlease enter *subscribe* followed by the orchestrator address " \
-                    "(e.g. 'subscribe 0x525419FF5707190389bfb5C87c375D710F5fCb0E') to get notified about the following events:\n - " \
-                    "reward calls\n - missed reward calls\n - when the reward/fee cut changes\n - orchestrator becomes inactive\n\n" \
-                    "If you no longer want to be notified, enter *remove* followed the orchestrator address.\n\n" \
-                    "If you want to check your subscriptions, enter *subscriptions*.", chat_id)
-            elif "subscribe" in message.lower() and "0x" in message:
-                transcoderChecksum = getTranscoder_IfValid(message, chat_id)
-                if transcoderChecksum:
-                    with open("transcoder_subscriptions.json", "r") as f:
-                        subscriptions = json.load(f)
-                    handleSubscription(subscriptions, chat_id, transcoderChecksum)
-            elif "remove" in message.lower() and "0x" in message:
-                transcoderChecksum = getTranscoder_IfValid(message, chat_id)
-                if transcoderChecksum:
-                    with open("transcoder_subscriptions.json", "r") as f:
-                        subscriptions = json.load(f)
-                    handleUnsubscribe(subscriptions, chat_id, transcoderChecksum)
-            elif "subscriptions" in message.lower():
-                displaySubscriptions(chat_id)
-            else:
-                send_message("The following commands are available:\n - *subscribe* <orchestrator address>\n - *remove* <orchestrator address>\n - *subscriptions*", chat_id)
+            remove_handled_update(update["update_id"])
         except Exception as ex:
             print(ex)
-            send_message(ex, MY_TELEGRAM_ID)
+        record_latency(time.time() - received)
+
+def remove_handled_update(update_id):
+    """Forgets the handled update, retried while watcher.db is locked by the watcher.
+
+    If it still fails, the update stays pending and is handled again after the next restart.
+    """
+    for attempt in range(remove_retries):
+        try:
+            store.remove_update(update_id)
+            return
+        except sqlite3.OperationalError as ex:
+            print(ex)
+            time.sleep(1)
+    print("Handled update {} is still pending".format(update_id))
+
+def worker_queue(update):
+    """All updates of a chat are handled by the same worker
+    """
+    chat_id = update.get("message", {}).get("chat", {}).get("id", 0)
+    return queues[hash(chat_id) % workers]
+
+def accept_updates(updates, block=True):
+    """Stores the updates until they are handled and hands the new ones to the workers.
+
+    Updates telegram sends again are skipped. Without block, nothing is accepted (returns False) if a worker is behind.
+    """
+    if not block and any(worker_queue(update).full() for update in updates):
+        return False
+    received = time.time()
+    new = store.add_updates(updates)
+    UPDATES.inc(len(new))
+    for update in new:
+        # Blocks if the worker is behind
+        worker_queue(update).put((update, received))
+    return True
+
+def checkMessage(updates):
+    """Hands the updates of a getUpdates response to the workers
+    """
+    accept_updates(updates["result"])
+
+def start():
+    """Starts the workers and hands them the updates which were received but not handled before the last shutdown
+    """
+    load_chat_subscriptions()
+    notifier.start()
+    w3.provider.start()
+    start_server(metrics_port)
+    subscriptionWriter.start()
+    for i in range(workers):
+        queues.append(queue.Queue(maxsize=worker_queue_size))
+        threading.Thread(target=worker, args=(queues[i],), daemon=True).start()
+    for update in store.get_pending_updates():
+        worker_queue(update).put((update, time.time()))
 
 def main():
-    last_update_id = None
+    """Long polling mode
+    """
+    start()
+    # getUpdates doesn't work while a webhook is set
+    call_api("deleteWebhook")
+    last_update_id = store.get_checkpoint("telegramUpdateId")
     while True:
-        updates = get_updates(last_update_id)
+        try:
+            updates = get_updates(last_update_id + 1 if last_update_id else None)
+        except Exception as ex:
+            print(ex)
+            time.sleep(1)
+            continue
         if updates.get("result"):
-            last_update_id = get_last_update_id(updates) + 1
-            checkMessage(updates)
-        time.sleep(1)
+            try:
+                checkMessage(updates)
+            except sqlite3.OperationalError as ex:
+                # watcher.db is locked by the watcher, the updates are fetched again
+                print(ex)
+                time.sleep(1)
+                continue
+            last_update_id = get_last_update_id(updates)
 
-if __name__ == '__main__':
-    main()
+def webhook_app(secret):
+    """aiohttp app receiving the updates telegram pushes to the webhook.
 
+    Every update is acknowledged as soon as it is stored and queued. If a worker is behind or watcher.db is locked,
+    the update is refused with 503 and telegram delivers it again later.
+    """
+    async def handle(request):
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status=403)
+        update = await request.json()
+        try:
+            # The store may wait for the lock, not on the event loop
+            accepted = await asyncio.get_running_loop().run_in_executor(None, accept_updates, [update], False)
+        except sqlite3.OperationalError as ex:
+            print(ex)
+            accepted = False
+        if not accepted:
+            return web.Response(status=503)
+        return web.Response()
+    app = web.Application()
+    app.router.add_post("/", handle)
+    return app
+
+def main_webhook(url):
+    """Webhook mode: telegram pushes the updates to url, which has to be forwarded to webhook_address:webhook_port
+    """
+    start()
+    # Only requests with this token in the header are from telegram
+    secret = secrets.token_hex(32)
+    call_api("setWebhook", url=url, secret_token=secret, allowed_updates=json.dumps(["message"]))
+    web.run_app(webhook_app(secret), host=webhook_address, port=webhook_port, print=None)
+
+if __name__ == '__main__':
+    if "--webhook" in sys.argv:
+        main_webhook(sys.argv[sys.argv.index("--webhook") + 1])
+    else:
+        main()
@@ -0,0 +1,21 @@
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def load_setup():
+    """setup.py is a template, the tests use it with a dummy telegram id and local endpoints
+    """
+    with open(os.path.join(ROOT, "setup.py")) as f:
+        source = f.read().replace("<CHAT-ID>", "0")
+    module = types.ModuleType("setup")
+    module.__file__ = os.path.join(ROOT, "setup.py")
+    exec(compile(source, module.__file__, "exec"), module.__dict__)
+    module.ARBITRUM_ENDPOINTS = [("http://127.0.0.1:1", None)]
+    module.MAINNET_ENDPOINTS = [("http://127.0.0.1:1", None)]
+    module.TEL_URL = "http://127.0.0.1:1/bot/"
+    return module
+
+sys.modules.setdefault("setup", load_setup())
@@ -0,0 +1,55 @@
+import threading
+import pytest
+from logscan import ChunkSizer, is_range_error, iter_chunks
+
+class FakeLogs:
+    """get_logs stand-in rejecting ranges larger than limit blocks, one log per block
+    """
+
+    def __init__(self, limit, error="query returned more than 10000 results"):
+        self.limit = limit
+        self.error = error
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def __call__(self, start, end):
+        with self.lock:
+            self.requests.append((start, end))
+        if end - start + 1 > self.limit:
+            raise ValueError({"code": -32005, "message": self.error})
+        return list(range(start, end + 1))
+
+def covered(chunks):
+    assert [start for start, end, logs in chunks[1:]] == [end + 1 for start, end, logs in chunks[:-1]]
+    return [log for start, end, logs in chunks for log in logs]
+
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_rejected_ranges_are_split(prefetch):
+    getLogs = FakeLogs(limit=300)
+    sizer = ChunkSizer(size=1000)
+    chunks = list(iter_chunks(getLogs, 1, 2000, sizer, prefetch))
+    assert covered(chunks) == list(range(1, 2001))
+    assert chunks[0][:2] == (1, 250)
+    assert all(end - start + 1 <= 300 for start, end, logs in chunks)
+    # The rejected request was retried smaller
+    assert getLogs.requests[:2] == [(1, 1000), (1, 500)]
+
+def test_chunks_grow_while_requests_are_fast():
+    sizer = ChunkSizer(size=10, maxSize=100)
+    chunks = list(iter_chunks(FakeLogs(limit=10**6), 1, 1000, sizer, prefetch=False))
+    assert covered(chunks) == list(range(1, 1001))
+    assert chunks[0][:2] == (1, 10)
+    assert sizer.size == 100
+
+def test_other_errors_are_raised():
+    getLogs = FakeLogs(limit=10, error="internal error")
+    with pytest.raises(ValueError):
+        list(iter_chunks(getLogs, 1, 100, ChunkSizer(size=50)))
+
+def test_single_block_is_not_split():
+    with pytest.raises(ValueError):
+        list(iter_chunks(FakeLogs(limit=0), 5, 5, ChunkSizer(size=50), prefetch=False))
+
+def test_is_range_error():
+    assert is_range_error(ValueError({"message": "Log response size exceeded. You can make eth_getLogs requests with up to a 2K block range"}))
+    assert not is_range_error(ValueError("execution reverted"))
@@ -0,0 +1,31 @@
+import json
+from web3 import Web3
+from bench import POOL_SIZE, SyntheticChain
+from metrics import render
+from multicall import MULTICALL_CALLS, MULTICALL_LATENCY, get_multicall, get_pool_snapshot
+from setup import BONDING_MANAGER_ABI, BONDING_MANAGER_PROXY
+
+def make_chain(size):
+    chain = SyntheticChain(size)
+    w3 = Web3(chain)
+    return chain, w3.eth.contract(address=BONDING_MANAGER_PROXY, abi=json.loads(BONDING_MANAGER_ABI)), get_multicall(w3)
+
+def test_pool_snapshot_with_hint_is_one_request():
+    chain, bonding_manager, multicall = make_chain(POOL_SIZE)
+    snapshot = get_pool_snapshot(bonding_manager, multicall)
+    assert list(snapshot) == chain.pool
+    chain.calls.clear()
+    chain.functionCalls.clear()
+    assert get_pool_snapshot(bonding_manager, multicall, previous=snapshot) == snapshot
+    assert chain.calls["eth_call"] == 1
+    assert chain.functionCalls["aggregate3"] == 1
+    assert chain.functionCalls["getTranscoder"] == POOL_SIZE
+
+def test_batched_functions_are_recorded():
+    chain, bonding_manager, multicall = make_chain(10)
+    before = MULTICALL_CALLS.values.get((("function", "getTranscoder"),), 0)
+    get_pool_snapshot(bonding_manager, multicall, previous=chain.pool)
+    assert MULTICALL_CALLS.values[(("function", "getTranscoder"),)] == before + 10
+    batch = "getFirstTranscoderInPool+getNextTranscoderInPool+getTranscoder+getTranscoderPoolSize+transcoderTotalStake"
+    assert (("batch", batch),) in MULTICALL_LATENCY.values
+    assert 'rpc_multicall_calls_total{function="getNextTranscoderInPool"}' in render()
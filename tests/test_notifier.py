@@ -0,0 +1,118 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import pytest
+from notifier import Notifier, split_digest
+from store import Store
+
+class FakeTelegram:
+    """Local stand-in for the sendMessage API, answers with the scripted status codes (then 200)
+    """
+
+    def __init__(self):
+        self.received = []
+        self.statuses = []
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+                with fake.lock:
+                    status = fake.statuses.pop(0) if fake.statuses else 200
+                    fake.received.append((body["text"][0], int(body["chat_id"][0]), status))
+                response = {"ok": status == 200}
+                if status == 429:
+                    response["parameters"] = {"retry_after": 0.05}
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}/bot/".format(self.server.server_address[1])
+
+    def texts(self, status=200):
+        return [(text, chat_id) for text, chat_id, s in self.received if s == status]
+
+@pytest.fixture
+def telegram():
+    fake = FakeTelegram()
+    yield fake
+    fake.server.shutdown()
+
+def make_notifier(url, outbox=None, maxRetries=5):
+    return Notifier(url=url, globalRate=1000, chatRate=1000, maxRetries=maxRetries, retryDelay=0.01, outbox=outbox).start()
+
+def test_messages_of_a_chat_keep_their_order(telegram):
+    notifier = make_notifier(telegram.url)
+    for i in range(20):
+        notifier.send("message {}".format(i), i % 2)
+    assert notifier.join(10)
+    for chat_id in (0, 1):
+        assert [t for t, c in telegram.texts() if c == chat_id] == ["message {}".format(i) for i in range(chat_id, 20, 2)]
+
+def test_server_errors_are_retried(telegram):
+    telegram.statuses = [500, 502, 429]
+    store = Store(":memory:")
+    notifier = make_notifier(telegram.url, store)
+    notifier.add_digest("first", 1)
+    notifier.flush_digests()
+    notifier.release()
+    notifier.send("second", 1)
+    assert notifier.join(10)
+    assert telegram.texts() == [("first", 1), ("second", 1)]
+    assert len(telegram.received) == 5
+    assert store.get_outbox() == []
+
+def test_rejected_messages_are_dropped(telegram):
+    telegram.statuses = [400]
+    store = Store(":memory:")
+    notifier = make_notifier(telegram.url, store)
+    notifier.add_digest("rejected", 1)
+    notifier.flush_digests()
+    notifier.release()
+    assert notifier.join(10)
+    assert len(telegram.received) == 1
+    assert store.get_outbox() == []
+
+def test_undelivered_messages_stay_in_the_outbox(telegram):
+    telegram.statuses = [503] * 3
+    store = Store(":memory:")
+    notifier = make_notifier(telegram.url, store, maxRetries=2)
+    notifier.add_digest("down", 1)
+    notifier.flush_digests()
+    notifier.release()
+    assert notifier.join(10)
+    assert len(telegram.received) == 3
+    assert [(text, chat_id) for id, text, chat_id in store.get_outbox()] == [("down", 1)]
+    # Sent by the next start
+    restarted = make_notifier(telegram.url, store)
+    assert restarted.join(10)
+    assert telegram.texts() == [("down", 1)]
+    assert store.get_outbox() == []
+
+def test_connection_errors_are_retried():
+    store = Store(":memory:")
+    # Nothing listens on the port yet
+    server = FakeTelegram()
+    url = server.url
+    server.server.shutdown()
+    server.server.server_close()
+    notifier = make_notifier(url, store, maxRetries=1)
+    notifier.add_digest("offline", 1)
+    notifier.flush_digests()
+    notifier.release()
+    assert notifier.join(10)
+    assert len(store.get_outbox()) == 1
+
+def test_split_digest():
+    assert split_digest(["a", "b"], limit=10) == ["a\n\nb"]
+    assert split_digest(["aaaa", "bbbb", "cccc"], limit=10) == ["aaaa\n\nbbbb", "cccc"]
+    assert split_digest(["x" * 25], limit=10) == ["x" * 10, "x" * 10, "x" * 5]
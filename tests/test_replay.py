@@ -0,0 +1,11 @@
+import os
+from bench import SyntheticChain
+from replay import load_watcher
+
+def test_load_watcher_never_opens_watcher_db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("WATCHER_DB", raising=False)
+    watcher = load_watcher(SyntheticChain(10))
+    assert os.listdir(tmp_path) == []
+    assert watcher.sharedStore.path == ":memory:"
+    assert "WATCHER_DB" not in os.environ
@@ -0,0 +1,136 @@
+import threading
+import time
+import pytest
+import rpcpool
+from rpcpool import ProviderPool, set_budget_share
+
+class StubProvider:
+    """Answers every request with the given block number after delay seconds, or fails
+    """
+
+    def __init__(self, name, block=100, delay=0, fail=False):
+        self.name = name
+        self.block = block
+        self.delay = delay
+        self.fail = fail
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def make_request(self, method, params):
+        with self.lock:
+            self.requests.append(method)
+        time.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError("{} is down".format(self.name))
+        return {"jsonrpc": "2.0", "id": 1, "result": hex(self.block) if method == "eth_blockNumber" else self.name}
+
+    def isConnected(self):
+        return not self.fail
+
+def make_pool(stubs, rates=None, **kwargs):
+    rates = rates or [None] * len(stubs)
+    pool = ProviderPool([("http://{}.invalid".format(stub.name), rate) for stub, rate in zip(stubs, rates)], **kwargs)
+    for endpoint, stub in zip(pool.endpoints, stubs):
+        endpoint.provider = stub
+    return pool
+
+@pytest.fixture(autouse=True)
+def reset_budgets():
+    rpcpool.budgets.clear()
+    set_budget_share(1)
+    yield
+    rpcpool.budgets.clear()
+    set_budget_share(1)
+
+def test_fails_over_to_the_next_endpoint():
+    down, up = StubProvider("down", fail=True), StubProvider("up")
+    pool = make_pool([down, up])
+    # Unmeasured endpoints go first, in order
+    assert pool.make_request("eth_getBalance", [])["result"] == "up"
+    assert down.requests == ["eth_getBalance"]
+    assert not pool.endpoints[0].healthy
+    # Unhealthy endpoints are skipped
+    pool.make_request("eth_getBalance", [])
+    assert down.requests == ["eth_getBalance"]
+
+def test_raises_if_all_endpoints_fail():
+    pool = make_pool([StubProvider("a", fail=True), StubProvider("b", fail=True)])
+    with pytest.raises(ConnectionError):
+        pool.make_request("eth_getBalance", [])
+
+def test_hedged_request_fails_over():
+    down, up = StubProvider("down", fail=True), StubProvider("up")
+    pool = make_pool([down, up], hedgeAfter=5)
+    start = time.time()
+    assert pool.make_request("eth_call", [])["result"] == "up"
+    assert time.time() - start < 1
+
+def test_slow_requests_are_hedged():
+    slow, fast = StubProvider("slow", delay=1), StubProvider("fast")
+    pool = make_pool([slow, fast], hedgeAfter=0.05)
+    start = time.time()
+    assert pool.make_request("eth_call", [])["result"] == "fast"
+    assert time.time() - start < 0.5
+    assert slow.requests == ["eth_call"] and fast.requests == ["eth_call"]
+
+def test_hedge_delay_follows_the_latencies_of_the_method():
+    pool = make_pool([StubProvider("a"), StubProvider("b")], hedgeAfter=0.01, hedgePercentile=0.9)
+    assert pool.hedge_delay("eth_getLogs") == 0.01
+    pool.latencies["eth_getLogs"] = [0.1 * i for i in range(1, 11)]
+    pool.latencies["eth_call"] = [0.001] * 10
+    assert pool.hedge_delay("eth_getLogs") == pytest.approx(1.0)
+    assert pool.hedge_delay("eth_call") == 0.01
+
+def test_unhedged_methods_go_to_one_endpoint():
+    slow, fast = StubProvider("slow", delay=0.2), StubProvider("fast")
+    pool = make_pool([slow, fast], hedgeAfter=0.01)
+    pool.make_request("eth_blockNumber", [])
+    assert len(slow.requests) + len(fast.requests) == 1
+
+def test_health_check_skips_lagging_endpoints():
+    behind, current = StubProvider("behind", block=50), StubProvider("current", block=100)
+    pool = make_pool([behind, current], maxLag=20)
+    pool.check_health()
+    assert [e.healthy for e in pool.endpoints] == [False, True]
+    assert pool.make_request("eth_getBalance", [])["result"] == "current"
+    behind.block = 90
+    pool.check_health()
+    assert all(e.healthy for e in pool.endpoints)
+
+def test_requests_wait_for_the_budget():
+    stub = StubProvider("limited")
+    pool = make_pool([stub], rates=[20])
+    start = time.time()
+    for i in range(30):
+        pool.make_request("eth_getBalance", [])
+    # 20 requests at once, the next 10 at 20 per second
+    assert 0.4 < time.time() - start < 1
+
+def test_budget_is_shared_by_the_pools_of_the_process():
+    first, second = StubProvider("shared"), StubProvider("shared")
+    pools = [make_pool([first], rates=[20]), make_pool([second], rates=[20])]
+    assert pools[0].endpoints[0].bucket is pools[1].endpoints[0].bucket
+    start = time.time()
+    for i in range(30):
+        pools[i % 2].make_request("eth_getBalance", [])
+    assert 0.4 < time.time() - start < 1
+
+def test_budget_share_limits_the_process():
+    pool = make_pool([StubProvider("share")], rates=[40])
+    set_budget_share(0.5)
+    bucket = pool.endpoints[0].bucket
+    assert (bucket.rate, bucket.capacity) == (20, 20)
+    start = time.time()
+    for i in range(30):
+        pool.make_request("eth_getBalance", [])
+    assert 0.4 < time.time() - start < 1
+    # Never below one request at a time
+    set_budget_share(0.01)
+    assert bucket.capacity == 1
+
+def test_cached_methods_are_only_sent_once():
+    stub = StubProvider("a")
+    pool = make_pool([stub])
+    pool.make_request("eth_chainId", [])
+    pool.make_request("eth_chainId", [])
+    assert stub.requests == ["eth_chainId"]
@@ -0,0 +1,49 @@
+from schedule import RoundSchedule, TimerWheel
+
+def test_advance_returns_the_due_items_in_block_order():
+    wheel = TimerWheel(slots=8)
+    wheel.add(12, "b")
+    wheel.add(5, "a")
+    wheel.add(20, "c")
+    assert wheel.advance(4) == []
+    assert wheel.advance(12) == ["a", "b"]
+    assert wheel.next_block() == 20
+
+def test_advance_across_the_slot_wraparound():
+    wheel = TimerWheel(slots=8)
+    wheel.advance(14)
+    # 17 and 25 share a slot, the wheel wraps from slot 7 to slot 0 on the way to 19
+    wheel.add(17, "first lap")
+    wheel.add(25, "second lap")
+    wheel.add(15, "slot 7")
+    assert wheel.advance(19) == ["slot 7", "first lap"]
+    assert wheel.advance(24) == []
+    assert wheel.advance(25) == ["second lap"]
+    assert wheel.next_block() is None
+
+def test_advance_further_than_the_wheel_checks_every_slot():
+    wheel = TimerWheel(slots=8)
+    wheel.advance(0)
+    for block in (3, 9, 30, 31, 100):
+        wheel.add(block, block)
+    assert wheel.advance(50) == [3, 9, 30, 31]
+    assert wheel.advance(200) == [100]
+
+def test_items_for_passed_blocks_are_due_with_the_next_advance():
+    wheel = TimerWheel(slots=8)
+    wheel.advance(10)
+    wheel.add(7, "late")
+    assert wheel.advance(10) == ["late"]
+    assert wheel.advance(11) == []
+
+def test_clear():
+    wheel = TimerWheel(slots=8)
+    wheel.add(3, "a")
+    wheel.clear()
+    assert wheel.advance(100) == []
+
+def test_round_schedule():
+    schedule = RoundSchedule(3000, 1000, 5760, (0.5, 0.8, 0.95))
+    assert schedule.end == 6760
+    assert schedule.deadlines == [(3880, 0.5), (5608, 0.8), (6472, 0.95)]
+    assert schedule.progress(3880) == 2880
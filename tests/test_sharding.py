@@ -0,0 +1,91 @@
+from collections import Counter
+import pytest
+from bench import NEW_ROUND_TOPIC, REWARD_TOPIC, SyntheticChain, address_topic, topic
+from replay import load_watcher
+from sharding import HashRing
+from store import Store
+
+ADDRESSES = ["0x" + hex(0x1000 + i)[2:].rjust(40, "0") for i in range(400)]
+
+def test_hash_ring_spreads_the_keys():
+    ring = HashRing(4)
+    counts = Counter(ring.shard(a) for a in ADDRESSES)
+    assert sorted(counts) == [0, 1, 2, 3]
+    assert min(counts.values()) > len(ADDRESSES) / 4 / 2
+    # Independent of the case of the address and of the instance
+    assert [HashRing(4).shard(a.upper().replace("0X", "0x")) for a in ADDRESSES] == [ring.shard(a) for a in ADDRESSES]
+
+def test_hash_ring_resize_only_moves_the_keys_of_the_removed_shard():
+    before, after = HashRing(4), HashRing(3)
+    for a in ADDRESSES:
+        if before.shard(a) != 3:
+            assert after.shard(a) == before.shard(a)
+
+class FakeTranscoder:
+    def __init__(self, address, rewardCalled, isActive):
+        self.address, self.rewardCalled, self.isActive = address, rewardCalled, isActive
+
+@pytest.fixture
+def watcher(tmp_path):
+    watcher = load_watcher(SyntheticChain(10))
+    watcher.store = watcher.sharedStore = Store(str(tmp_path / "watcher.db"))
+    return watcher
+
+def fill(store, orchestrators):
+    store.set_checkpoint("arbitrumBlock", 500)
+    store.set_checkpoint("mainnetBlock", 900)
+    store.set_checkpoint("roundNr", 3000)
+    store.set_transcoder_flags([FakeTranscoder(a, i % 2 == 0, True) for i, a in enumerate(orchestrators)])
+    for i, a in enumerate(orchestrators):
+        store.add_ticket(a, 100 + i, 0.1, 0.05, topic(i), "key")
+        store.add_processed_log(topic(i), "key", i, 100 + i, topic(100 + i), [REWARD_TOPIC, address_topic(a)], "0x01")
+    store.add_processed_log(topic(999), "key", 0, 99, topic(99), [NEW_ROUND_TOPIC, topic(3000)], "0x00")
+    store.add_outbox([("queued", 1), ("queued", 2)])
+
+def assert_owned(watcher, count, orchestrators):
+    stores = [Store(watcher.shard_store_path(i, count)) for i in range(count)] if count else [watcher.sharedStore]
+    ring = HashRing(len(stores))
+    for index, store in enumerate(stores):
+        flags, tickets, logs = store.get_orchestrator_state()
+        owned = [a for a in orchestrators if ring.shard(a) == index]
+        assert sorted(row[0] for row in flags) == sorted(owned)
+        assert sorted(row[0] for row in tickets) == sorted(owned)
+        # Events concerning all orchestrators go to every shard
+        assert sorted(row[0] for row in logs) == sorted([topic(orchestrators.index(a)) for a in owned] + [topic(999)])
+        assert store.get_checkpoint("arbitrumBlock") == 500
+        assert store.get_checkpoint("roundNr") == 3000
+    assert [(text, chat_id) for id, text, chat_id in stores[0].get_outbox()] == [("queued", 1), ("queued", 2)]
+    assert all(not store.get_outbox() for store in stores[1:])
+    return stores
+
+def test_move_orchestrator_state_on_a_resize(watcher):
+    orchestrators = [watcher.w3.toChecksumAddress(a) for a in ADDRESSES[:40]]
+    fill(watcher.sharedStore, orchestrators)
+    watcher.move_orchestrator_state(4)
+    assert watcher.sharedStore.get_checkpoint("shards") == 4
+    assert watcher.sharedStore.get_outbox() == []
+    assert_owned(watcher, 4, orchestrators)
+    watcher.move_orchestrator_state(3)
+    stores = assert_owned(watcher, 3, orchestrators)
+    # The flags move along
+    flags = dict((row[0], row[1]) for store in stores for row in store.get_orchestrator_state()[0])
+    assert flags == {a: int(i % 2 == 0) for i, a in enumerate(orchestrators)}
+    # Back to a single process
+    watcher.move_orchestrator_state(0)
+    assert_owned(watcher, 0, orchestrators)
+    assert watcher.sharedStore.get_checkpoint("shards") == 0
+
+def test_move_orchestrator_state_keeps_an_unchanged_count(watcher):
+    fill(watcher.sharedStore, [watcher.w3.toChecksumAddress(ADDRESSES[0])])
+    watcher.move_orchestrator_state(0)
+    assert len(watcher.sharedStore.get_outbox()) == 2
+
+def test_shard_pool_partition():
+    from sharding import ShardPool
+    pool = ShardPool(3, None)
+    events = [{"orchestrator": a} for a in ADDRESSES[:30]] + [{"orchestrator": None}]
+    parts = pool.partition(events, lambda event: event["orchestrator"])
+    for index, part in enumerate(parts):
+        assert part[-1] == {"orchestrator": None}
+        assert all(pool.ring.shard(e["orchestrator"]) == index for e in part[:-1])
+    assert sum(len(part) for part in parts) == 30 + 3
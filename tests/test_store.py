@@ -0,0 +1,93 @@
+import store as store_module
+from store import Store, UPDATES_KEPT, log_key
+
+def test_add_updates_skips_updates_received_before():
+    store = Store(":memory:")
+    assert [u["update_id"] for u in store.add_updates([{"update_id": 5}, {"update_id": 7}])] == [5, 7]
+    assert store.add_updates([{"update_id": 7}, {"update_id": 5}]) == []
+    assert store.get_checkpoint("telegramUpdateId") == 7
+
+def test_add_updates_accepts_updates_out_of_order():
+    store = Store(":memory:")
+    store.add_updates([{"update_id": 5}, {"update_id": 7}])
+    # A webhook delivery of 6 was refused and is retried after 7 was accepted
+    assert store.add_updates([{"update_id": 6}]) == [{"update_id": 6}]
+    assert store.add_updates([{"update_id": 6}]) == []
+    assert store.get_checkpoint("telegramUpdateId") == 7
+
+def test_add_updates_remembers_handled_updates():
+    store = Store(":memory:")
+    store.add_updates([{"update_id": 1, "message": {"text": "a"}}, {"update_id": 2, "message": {"text": "b"}}])
+    store.remove_update(1)
+    assert store.get_pending_updates() == [{"update_id": 2, "message": {"text": "b"}}]
+    assert store.add_updates([{"update_id": 1}]) == []
+
+def test_add_updates_forgets_ids_outside_the_window():
+    store = Store(":memory:")
+    store.add_updates([{"update_id": 1}])
+    store.add_updates([{"update_id": 1 + UPDATES_KEPT}])
+    assert store.conn.execute("SELECT update_id FROM received_updates").fetchall() == [(1 + UPDATES_KEPT,)]
+    # Too old to be told apart from a handled one
+    assert store.add_updates([{"update_id": 1}]) == []
+    assert store.add_updates([{"update_id": 2}]) == [{"update_id": 2}]
+
+def test_moved_log_keeps_its_key():
+    store = Store(":memory:")
+    topics = ["0x619caafabdd75649b302ba8419e48cccf64f37f1983ac4727cfb38b57703ffc9", "0x" + "0" * 24 + "1" * 40]
+    key = log_key(topics, "0x01")
+    assert store.add_processed_log("0xaa", key, 3, 100, "0xb1", topics, "0x01")
+    # The transaction was included in another block after a reorg, at another position
+    assert not store.add_processed_log("0xaa", key, 7, 101, "0xb2", topics, "0x01")
+    assert store.get_processed_logs(0, 200) == [("0xaa", key, 7, 101, "0xb2", topics, "0x01")]
+    # An identical event of the same transaction
+    assert log_key(topics, "0x01", 1) != key
+    assert store.add_processed_log("0xaa", log_key(topics, "0x01", 1), 8, 101, "0xb2", topics, "0x01")
+    assert store.remove_processed_log("0xaa", key)
+    assert not store.is_processed_log("0xaa", key)
+    assert store.is_processed_log("0xaa", log_key(topics, "0x01", 1))
+
+def test_remove_indexed_event_returns_the_round_of_the_reward_call():
+    store = Store(":memory:")
+    store.add_reward_call("0xaa", "k1", 3000, "0x01", 100, 10.0)
+    store.add_ticket_redemption("0xbb", "k2", 3000, "0x01", 101, 0.1)
+    assert store.remove_indexed_event("0xaa", "k1") == 3000
+    assert store.remove_indexed_event("0xbb", "k2") is None
+    assert store.get_transcoder_stats("0x01", 0)["rewardRounds"] == 0
+    assert store.get_transcoder_stats("0x01", 0)["tickets"] == 0
+
+def test_transcoder_stats_before_the_first_indexed_round():
+    store = Store(":memory:")
+    store.add_reward_call("0xaa", "k1", 3000, "0x01", 100, 10.0)
+    store.add_ticket_redemption("0xbb", "k2", 3000, "0x01", 101, 0.1)
+    stats = store.get_transcoder_stats("0x01", 2971)
+    assert not stats["indexed"]
+    assert (stats["firstRound"], stats["activeRounds"], stats["rewardRounds"], stats["tickets"]) == (3000, 0, 1, 1)
+    store.add_active_transcoders(3001, ["0x01"])
+    store.add_reward_call("0xcc", "k3", 3001, "0x01", 200, 10.0)
+    stats = store.get_transcoder_stats("0x01", 2972)
+    assert stats["indexed"]
+    assert (stats["firstRound"], stats["activeRounds"], stats["rewardRounds"], stats["rewards"]) == (3001, 1, 1, 10.0)
+
+def test_subscription_changes_since_a_version():
+    store = Store(":memory:")
+    assert store.get_subscription_changes(0) == (0, [])
+    assert store.add_subscription("0x01", 1)
+    assert not store.add_subscription("0x01", 1)
+    assert store.add_subscription("0x02", 1)
+    version, subscriptions = store.get_subscriptions()
+    assert (version, subscriptions) == (2, {"0x01": [1], "0x02": [1]})
+    assert store.remove_subscription("0x01", 1)
+    assert not store.remove_subscription("0x01", 1)
+    assert store.get_subscription_changes(0) == (3, [("0x01", 1, True), ("0x02", 1, True), ("0x01", 1, False)])
+    assert store.get_subscription_changes(version) == (3, [("0x01", 1, False)])
+    assert store.get_subscription_changes(3) == (3, [])
+
+def test_subscription_changes_which_are_no_longer_kept(monkeypatch):
+    monkeypatch.setattr(store_module, "CHANGES_KEPT", 3)
+    store = Store(":memory:")
+    for i in range(6):
+        store.add_subscription("0x{:02}".format(i), 1)
+    assert store.get_subscription_changes(3) == (6, [("0x03", 1, True), ("0x04", 1, True), ("0x05", 1, True)])
+    # Readers behind the kept changes (or ahead of a new database) reload everything
+    assert store.get_subscription_changes(2) == (6, None)
+    assert store.get_subscription_changes(7) == (6, None)
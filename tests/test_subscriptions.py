@@ -0,0 +1,68 @@
+import asyncio
+import importlib.util
+import os
+import queue
+import sqlite3
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from rpcpool import set_budget_share
+
+@pytest.fixture
+def subscriptions(monkeypatch):
+    """telegram-subscriptions.py with an in-memory store and worker queues without workers
+    """
+    monkeypatch.setenv("WATCHER_DB", ":memory:")
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "telegram-subscriptions.py")
+    spec = importlib.util.spec_from_file_location("telegram_subscriptions", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # The import set the budget share of the script for the whole process
+    set_budget_share(1)
+    module.queues.extend(queue.Queue(maxsize=module.worker_queue_size) for i in range(module.workers))
+    return module
+
+def post(module, *updates, secret="secret"):
+    """Posts the updates to the webhook one after the other, returns the status codes
+    """
+    async def deliver():
+        async with TestClient(TestServer(module.webhook_app("secret"))) as client:
+            statuses = []
+            for update in updates:
+                response = await client.post("/", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+                statuses.append(response.status)
+            return statuses
+    return asyncio.run(deliver())
+
+def update(update_id, chat_id=1):
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "text": "/start"}}
+
+def queued(module):
+    return [q.get_nowait()[0]["update_id"] for q in module.queues for i in range(q.qsize())]
+
+def test_webhook_refuses_requests_without_the_secret_token(subscriptions):
+    assert post(subscriptions, update(1), secret="wrong") == [403]
+    assert queued(subscriptions) == []
+    assert subscriptions.store.get_pending_updates() == []
+
+def test_webhook_queues_every_update_once(subscriptions):
+    # Telegram delivers an update again if the response got lost
+    assert post(subscriptions, update(1), update(2, chat_id=2), update(1)) == [200, 200, 200]
+    assert sorted(queued(subscriptions)) == [1, 2]
+    assert [u["update_id"] for u in subscriptions.store.get_pending_updates()] == [1, 2]
+
+def test_webhook_refuses_updates_while_the_worker_is_behind(subscriptions):
+    worker = subscriptions.worker_queue(update(1))
+    for i in range(subscriptions.worker_queue_size):
+        worker.put((update(1000 + i), 0))
+    assert post(subscriptions, update(1)) == [503]
+    # Not stored, so it is accepted when telegram delivers it again
+    assert subscriptions.store.get_pending_updates() == []
+    worker.get_nowait()
+    assert post(subscriptions, update(1)) == [200]
+
+def test_webhook_refuses_updates_while_the_database_is_locked(subscriptions, monkeypatch):
+    def locked(updates):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(subscriptions.store, "add_updates", locked)
+    assert post(subscriptions, update(1)) == [503]
+    assert queued(subscriptions) == []
@@ -0,0 +1,187 @@
+import queue
+import time
+import pytest
+from web3.datastructures import AttributeDict
+from bench import ROUND, TICKET_TOPIC, SyntheticChain, address_topic, topic, word
+from replay import load_watcher
+from setup import TICKET_BROKER_PROXY
+from store import Store
+
+def ticket_log(address, txHash, block, logIndex):
+    return {"address": TICKET_BROKER_PROXY.lower(), "topics": [TICKET_TOPIC, address_topic(address), address_topic(address)],
+        "data": "0x" + word(2 * 10**15), "blockNumber": hex(block), "blockHash": topic(block), "transactionHash": txHash,
+        "transactionIndex": "0x0", "logIndex": hex(logIndex), "removed": False}
+
+@pytest.fixture
+def chain():
+    return SyntheticChain(10, blocks=100)
+
+@pytest.fixture
+def watcher(chain):
+    store = Store(":memory:")
+    store.set_checkpoint("arbitrumBlock", 0)
+    store.set_checkpoint("mainnetBlock", 0)
+    store.set_checkpoint("roundNr", ROUND)
+    store.add_subscription(chain.orchestrators[0], 1)
+    watcher = load_watcher(chain, store)
+    watcher.load_state()
+    watcher.update_transcoder_instances()
+    return watcher
+
+def count(store, table):
+    return store.conn.execute("SELECT COUNT(*) FROM " + table).fetchone()[0]
+
+def test_identical_logs_of_a_transaction_are_all_handled(chain, watcher):
+    # A batch redemption of two tickets with the same value emits two identical events
+    address = chain.orchestrators[0]
+    chain.logs = [ticket_log(address, topic(77), 10, 0), ticket_log(address, topic(77), 10, 1)]
+    watcher.commit_logs(watcher.get_logs(1, 10), 10, 1)
+    assert count(watcher.store, "tickets") == 2
+    assert count(watcher.store, "ticket_redemptions") == 2
+    assert count(watcher.store, "processed_logs") == 2
+    # The transaction was included in another block after a reorg, at other positions
+    chain.logs = [ticket_log(address, topic(77), 12, 4), ticket_log(address, topic(77), 12, 5)]
+    watcher.commit_logs(watcher.get_logs(1, 12), 12, 1)
+    assert count(watcher.store, "tickets") == 2
+    assert count(watcher.store, "ticket_redemptions") == 2
+    assert [row[2:4] for row in watcher.store.get_processed_logs(0, 20)] == [(4, 12), (5, 12)]
+    # One of them was dropped by another reorg
+    chain.logs = chain.logs[:1]
+    watcher.commit_logs(watcher.get_logs(1, 12), 12, 1)
+    assert count(watcher.store, "tickets") == 1
+    assert count(watcher.store, "ticket_redemptions") == 1
+
+def test_resubscribed_transcoder_does_not_restore_outdated_flags(chain, watcher):
+    address = chain.orchestrators[0]
+    watcher.transcoder[address].rewardCalled = False
+    watcher.commit_logs([], 10)
+    assert watcher.store.get_transcoder_flags(address) == (False, True)
+    watcher.store.remove_subscription(address, 1)
+    watcher.update_transcoder_instances()
+    assert address not in watcher.transcoder
+    watcher.commit_logs([], 20)
+    assert watcher.store.get_transcoder_flags(address) is None
+    watcher.store.add_subscription(address, 1)
+    watcher.update_transcoder_instances()
+    assert (watcher.transcoder[address].rewardCalled, watcher.transcoder[address].isActive) == (True, True)
+
+def test_transcoder_resubscribed_before_the_commit_does_not_restore_outdated_flags(chain, watcher):
+    address = chain.orchestrators[0]
+    watcher.transcoder[address].rewardCalled = False
+    watcher.commit_logs([], 10)
+    watcher.store.remove_subscription(address, 1)
+    watcher.update_transcoder_instances()
+    watcher.store.add_subscription(address, 2)
+    watcher.update_transcoder_instances()
+    assert watcher.transcoder[address].rewardCalled
+    watcher.commit_logs([], 20)
+    assert watcher.store.get_transcoder_flags(address) == (True, True)
+
+@pytest.fixture
+def stream(watcher, monkeypatch):
+    """The streaming state with a fake event queue, records the scans and commits
+    """
+    events, scans, commits = queue.Queue(), [], []
+    scan_new_blocks, commit_logs = watcher.scan_new_blocks, watcher.commit_logs
+
+    def scan(head):
+        scans.append(head)
+        scan_new_blocks(head)
+
+    def commit_streamed(logs, toBlock, fromBlock=None):
+        # Only the commits of streamed logs, not the chunks of the scans
+        if fromBlock is None:
+            commits.append(([e["blockNumber"] for e in logs], toBlock))
+        commit_logs(logs, toBlock, fromBlock)
+
+    monkeypatch.setattr(watcher, "scan_new_blocks", scan)
+    monkeypatch.setattr(watcher, "commit_logs", commit_streamed)
+    monkeypatch.setattr(watcher, "poll_interval", 60)
+    state = watcher.StreamState()
+
+    def feed(*items):
+        for item in items:
+            events.put(item)
+        return [state.step(events) for item in items]
+    return state, feed, scans, commits
+
+def streamed(watcher, chain, *logs):
+    """Returns the logs as the stream delivers them, by logIndex
+    """
+    chain.logs = list(logs)
+    return {e["logIndex"]: e for e in watcher.get_logs(0, chain.blocks)}
+
+def test_stream_commits_logs_once_their_block_is_complete(chain, watcher, stream):
+    state, feed, scans, commits = stream
+    address = chain.orchestrators[0]
+    logs = streamed(watcher, chain, ticket_log(address, topic(1), 5, 0), ticket_log(address, topic(2), 8, 1))
+    chain.logs = []
+    assert feed(("connected", "ws://node"), ("head", 3)) == [None, 3]
+    assert scans == [3] and watcher.arbitrumBlockOld == 3
+    state.lastFlush = time.time()
+    # Logs arrive before their head, they are committed with the next one
+    feed(("log", logs[0]), ("head", 5))
+    assert commits == [] and state.buffered == [logs[0]]
+    feed(("head", 6))
+    assert commits == [([5], 5)] and count(watcher.store, "tickets") == 1
+    # Or after it
+    feed(("head", 9), ("log", logs[1]), ("head", 10))
+    assert commits[1:] == [([8], 9)]
+    assert count(watcher.store, "tickets") == 2
+    assert state.buffered == [] and scans == [3]
+
+def test_stream_flushes_the_checkpoint_after_the_flush_interval(chain, watcher, stream):
+    state, feed, scans, commits = stream
+    feed(("head", 3))
+    state.lastFlush = time.time()
+    feed(("head", 4))
+    assert commits == [] and watcher.arbitrumBlockOld == 3
+    state.lastFlush = time.time() - watcher.stream_flush_interval - 1
+    feed(("head", 5))
+    assert commits == [([], 4)] and watcher.arbitrumBlockOld == 4
+
+def test_stream_drops_a_removed_log_which_is_still_buffered(chain, watcher, stream):
+    state, feed, scans, commits = stream
+    address = chain.orchestrators[0]
+    logs = streamed(watcher, chain, ticket_log(address, topic(1), 5, 0))
+    chain.logs = []
+    feed(("head", 3), ("log", logs[0]), ("log", AttributeDict(dict(logs[0], removed=True))), ("head", 6))
+    assert state.buffered == []
+    assert count(watcher.store, "tickets") == 0
+    assert all(blocks == [] for blocks, toBlock in commits)
+
+def test_stream_rolls_back_a_removed_log_which_was_committed(chain, watcher, stream):
+    state, feed, scans, commits = stream
+    address = chain.orchestrators[0]
+    logs = streamed(watcher, chain, ticket_log(address, topic(1), 5, 0))
+    chain.logs = []
+    feed(("head", 3), ("log", logs[0]), ("head", 6))
+    assert count(watcher.store, "tickets") == 1
+    feed(("log", AttributeDict(dict(logs[0], removed=True))), ("head", 7))
+    assert commits[-1] == ([5], 6)
+    assert count(watcher.store, "tickets") == 0
+    assert count(watcher.store, "processed_logs") == 0
+
+def test_stream_scans_again_after_a_late_log(chain, watcher, stream):
+    state, feed, scans, commits = stream
+    address = chain.orchestrators[0]
+    logs = streamed(watcher, chain, ticket_log(address, topic(1), 5, 0))
+    feed(("head", 3))
+    chain.logs = []
+    state.lastFlush = 0
+    feed(("head", 7))
+    assert watcher.arbitrumBlockOld == 6
+    # The log of block 5 arrives after its block was committed, the next head scans the blocks again
+    before = watcher.LATE_LOGS.values.get((), 0)
+    assert feed(("log", logs[0])) == [None]
+    assert watcher.LATE_LOGS.values[()] == before + 1 and not state.gapFilled
+    chain.logs = [ticket_log(address, topic(1), 5, 0)]
+    feed(("head", 8))
+    assert scans == [3, 8]
+    assert count(watcher.store, "tickets") == 1
+
+def test_stream_polls_without_events(chain, watcher, stream, monkeypatch):
+    state, feed, scans, commits = stream
+    monkeypatch.setattr(watcher, "poll_interval", 0.01)
+    assert state.step(queue.Queue()) == chain.blocks
+    assert scans == [chain.blocks]